@@ -0,0 +1,52 @@
+import os
+import logging
+
+import threading
+import time
+
+logger = logging.getLogger()
+
+# boto3 is imported and its clients are built on first use, so that cold starts
+# of events that never touch AWS services do not pay for them.
+resources = {}
+clients = {}
+tables = {}
+lock = threading.Lock()
+
+
+def boto3_module():
+    start = time.perf_counter()
+    import boto3
+    elapsed = time.perf_counter() - start
+    if elapsed > 0.001:
+        logger.info('boto3 imported: ' + str(round(elapsed * 1000, 1)) + 'ms')
+    return boto3
+
+
+def resource(name):
+    with lock:
+        if name not in resources:
+            resources[name] = boto3_module().resource(name, region_name=os.environ['Region'])
+        return resources[name]
+
+
+def client(name):
+    with lock:
+        if name not in clients:
+            clients[name] = boto3_module().client(name, region_name=os.environ['Region'])
+        return clients[name]
+
+
+# Code of a botocore ClientError ('ConditionalCheckFailedException', ...), None for other exceptions.
+# Checked by attribute so that modules handling these errors do not import botocore at cold start.
+def error_code(e):
+    response = getattr(e, 'response', None)
+    if not isinstance(response, dict):
+        return None
+    return response.get('Error', {}).get('Code')
+
+
+def table(table_name):
+    if table_name not in tables:
+        tables[table_name] = resource('dynamodb').Table(table_name)
+    return tables[table_name]
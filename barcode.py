@@ -0,0 +1,218 @@
+import os
+import logging
+import json
+
+import struct
+import threading
+import time
+import concurrent.futures
+import multiprocessing
+
+logger = logging.getLogger()
+
+# Longest side of the image used for the barcode search
+max_side = int(os.getenv('BARCODE_MAX_SIDE', '1600'))
+max_regions = int(os.getenv('BARCODE_MAX_REGIONS', '4'))
+decode_workers = int(os.getenv('BARCODE_WORKERS', str(os.cpu_count() or 1)))
+
+reduced_flags = [
+    (8, 'IMREAD_REDUCED_GRAYSCALE_8'),
+    (4, 'IMREAD_REDUCED_GRAYSCALE_4'),
+    (2, 'IMREAD_REDUCED_GRAYSCALE_2'),
+    (1, 'IMREAD_GRAYSCALE')
+]
+
+# numpy and cv2 are imported on the first image, text and postback events never load them
+np = None
+cv2 = None
+
+# BarcodeDetector is not shared between threads
+detectors = threading.local()
+
+
+def load_cv2():
+    global np, cv2
+    if cv2 is None:
+        start = time.perf_counter()
+        import numpy
+        import cv2 as opencv
+        np, cv2 = numpy, opencv
+        logger.info('cv2 imported: ' + str(round((time.perf_counter() - start) * 1000, 1)) + 'ms')
+    return cv2
+
+
+def get_detector():
+    if not hasattr(detectors, 'bd'):
+        detectors.bd = load_cv2().barcode.BarcodeDetector()
+    return detectors.bd
+
+
+# Width and height from the JPEG SOF or PNG IHDR header, None when unknown
+def image_size(buffer):
+    data = bytes(buffer[:32])
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        width, height = struct.unpack('>II', data[16:24])
+        return width, height
+    if data[:2] != b'\xff\xd8':
+        return None
+    view = memoryview(buffer)
+    i = 2
+    while i + 9 < len(view):
+        if view[i] != 0xff:
+            return None
+        marker = view[i + 1]
+        if marker == 0xff:
+            i += 1
+            continue
+        length = (view[i + 2] << 8) + view[i + 3]
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            height = (view[i + 5] << 8) + view[i + 6]
+            width = (view[i + 7] << 8) + view[i + 8]
+            return width, height
+        i += 2 + length
+    return None
+
+
+# Decodes straight to a reduced grayscale image so that the full resolution color image is never allocated
+def imdecode_reduced(arr, size):
+    if size is None:
+        img = cv2.imdecode(arr, cv2.IMREAD_GRAYSCALE)
+        if img is not None and max(img.shape) > max_side:
+            scale = max_side / max(img.shape)
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return img
+    # Largest reduction that keeps the longest side at max_side or more
+    for factor, flag in reduced_flags:
+        if factor == 1 or max(size) / factor >= max_side:
+            return cv2.imdecode(arr, getattr(cv2, flag))
+
+
+# Candidate barcode regions: strong gradient in one direction, closed into a solid block
+def find_regions(gray):
+    regions = []
+    grad_x = cv2.Scharr(gray, cv2.CV_32F, 1, 0)
+    grad_y = cv2.Scharr(gray, cv2.CV_32F, 0, 1)
+    for vertical in (False, True):
+        gradient = cv2.subtract(grad_y, grad_x) if vertical else cv2.subtract(grad_x, grad_y)
+        gradient = cv2.convertScaleAbs(gradient)
+        blurred = cv2.blur(gradient, (9, 9))
+        _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (7, 21) if vertical else (21, 7))
+        closed = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
+        closed = cv2.erode(closed, None, iterations=4)
+        closed = cv2.dilate(closed, None, iterations=4)
+        contours, _ = cv2.findContours(closed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        for contour in contours:
+            area = cv2.contourArea(contour)
+            if area < gray.shape[0] * gray.shape[1] * 0.002:
+                continue
+            x, y, w, h = cv2.boundingRect(contour)
+            regions.append((area, x, y, w, h))
+    regions.sort(reverse=True)
+
+    height, width = gray.shape[:2]
+    crops = []
+    for area, x, y, w, h in regions[:max_regions]:
+        pad_x = w // 4 + 10
+        pad_y = h // 4 + 10
+        crops.append((max(0, x - pad_x), max(0, y - pad_y), min(width, x + w + pad_x), min(height, y + h + pad_y)))
+    return crops
+
+
+def detect(img):
+    retval, decoded_info, decoded_type, points = get_detector().detectAndDecode(img)
+    if not retval:
+        return False, []
+    return True, [code for code in decoded_info if code != '']
+
+
+# Each crop is tried as is, then binarized, then rotated
+def decode_region(crop):
+    found, codes = detect(crop)
+    if len(codes) != 0:
+        return found, codes
+    _, binary = cv2.threshold(crop, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    found_binary, codes = detect(binary)
+    if len(codes) != 0:
+        return True, codes
+    found_rotated, codes = detect(cv2.rotate(crop, cv2.ROTATE_90_CLOCKWISE))
+    return found or found_binary or found_rotated, codes
+
+
+# Returns (found, codes, timings). found is False when no barcode was detected at all,
+# codes holds the decoded strings without duplicates.
+def decode(buffer):
+    timings = {}
+    start = time.perf_counter()
+
+    load_cv2()
+    arr = np.frombuffer(buffer, dtype=np.uint8)
+    gray = imdecode_reduced(arr, image_size(buffer))
+    timings['imdecode'] = time.perf_counter() - start
+    if gray is None:
+        return False, [], timings
+
+    t = time.perf_counter()
+    crops = find_regions(gray)
+    timings['regions'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    found = False
+    codes = []
+    for x1, y1, x2, y2 in crops:
+        region_found, region_codes = decode_region(gray[y1:y2, x1:x2])
+        found = found or region_found
+        codes += region_codes
+    timings['crops'] = time.perf_counter() - t
+
+    # Whole image as the last resort
+    if len(codes) == 0:
+        t = time.perf_counter()
+        full_found, codes = detect(gray)
+        found = found or full_found
+        timings['full'] = time.perf_counter() - t
+
+    timings['total'] = time.perf_counter() - start
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps({'barcode': {k: round(v * 1000, 2) for k, v in timings.items()}, 'shape': list(gray.shape), 'regions': len(crops)}))
+    return found, list(dict.fromkeys(codes)), timings
+
+
+def init_worker():
+    get_detector()
+
+
+executor = None
+executor_lock = threading.Lock()
+
+
+# Process pool with a warm BarcodeDetector per worker. Where processes cannot be used
+# (AWS Lambda has no /dev/shm for multiprocessing) threads are used, cv2 releases the GIL while decoding.
+# Workers are started by a fork server: forking this process, which already runs other threads,
+# could copy locks (e.g. the logging lock) held by those threads into the workers.
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            try:
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=decode_workers, initializer=init_worker, mp_context=multiprocessing.get_context('forkserver'))
+            except (OSError, NotImplementedError, ImportError, ValueError):
+                logger.info('Process pool unavailable, decoding with threads')
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=decode_workers, initializer=init_worker)
+        return executor
+
+
+# Decodes one image on the pool and waits for it, so that several images are decoded
+# in parallel, each as soon as it has been fetched
+def decode_pooled(buffer):
+    if decode_workers <= 1:
+        return decode(buffer)
+    pool = get_executor()
+    if isinstance(pool, concurrent.futures.ProcessPoolExecutor):
+        # memoryviews cannot be pickled
+        buffer = bytes(buffer)
+    try:
+        return pool.submit(decode, buffer).result()
+    except concurrent.futures.process.BrokenProcessPool:
+        logger.exception('Process pool broken, decoding in process')
+        return decode(buffer)
@@ -0,0 +1,274 @@
+import json
+
+import collections
+import copy
+import threading
+import time
+import types
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from botocore.exceptions import ClientError
+
+# Statuses handed out by the /check stand-in, picked per (isbn, libkey) so that runs are repeatable
+check_statuses = ['貸出可', '貸出中', '蔵書あり', '館内のみ']
+
+
+class Upstream:
+    # Local stand-in for Calil (/library, /check) and the LINE Messaging API (content, reply, push, multicast).
+    # A /check session answers 'continue': 1 for continue_rounds polls before the statuses are final.
+    def __init__(self, libraries, image=b'', continue_rounds=1, calil_delay=0.0, line_delay=0.0):
+        self.libraries = libraries
+        self.image = image
+        self.continue_rounds = continue_rounds
+        self.calil_delay = calil_delay
+        self.line_delay = line_delay
+        self.calls = collections.Counter()
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, without this every response waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                upstream.handle(self, 'GET')
+
+            def do_POST(self):
+                upstream.handle(self, 'POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:' + str(self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return collections.Counter(self.calls)
+
+    def handle(self, request, method):
+        url = urllib.parse.urlsplit(request.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        length = int(request.headers.get('Content-Length', '0'))
+        if length != 0:
+            request.rfile.read(length)
+
+        if method == 'GET' and url.path == '/library':
+            self.count('calil /library')
+            time.sleep(self.calil_delay)
+            self.send(request, 200, 'application/json', json.dumps(self.nearby(query), ensure_ascii=False).encode('utf-8'))
+        elif method == 'GET' and url.path == '/check':
+            self.count('calil /check')
+            time.sleep(self.calil_delay)
+            self.send(request, 200, 'application/json', json.dumps(self.check(query), ensure_ascii=False).encode('utf-8'))
+        elif method == 'GET' and url.path.startswith('/v2/bot/message/') and url.path.endswith('/content'):
+            self.count('line content')
+            time.sleep(self.line_delay)
+            self.send(request, 200, 'image/jpeg', self.image)
+        elif method == 'POST' and url.path.startswith('/v2/bot/message/'):
+            self.count('line ' + url.path.rsplit('/', 1)[1])
+            time.sleep(self.line_delay)
+            self.send(request, 200, 'application/json', b'{}')
+        else:
+            self.count('unknown ' + url.path)
+            self.send(request, 404, 'application/json', b'{}')
+
+    def send(self, request, status, content_type, body):
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def nearby(self, query):
+        lng, lat = (float(v) for v in query['geocode'].split(','))
+
+        def distance(library):
+            library_lng, library_lat = (float(v) for v in library['geocode'].split(','))
+            return (library_lat - lat) ** 2 + (library_lng - lng) ** 2
+
+        return sorted(self.libraries, key=distance)[:int(query.get('limit', '10'))]
+
+    def check(self, query):
+        with self.lock:
+            if 'session' in query:
+                session = self.sessions[query['session']]
+                session['round'] += 1
+            else:
+                session = {
+                    'id': uuid.uuid4().hex,
+                    'isbns': query['isbn'].split(','),
+                    'systemids': query['systemid'].split(','),
+                    'round': 0
+                }
+                self.sessions[session['id']] = session
+        running = session['round'] < self.continue_rounds
+        books = {}
+        for isbn in session['isbns']:
+            for systemid in session['systemids']:
+                if running:
+                    books.setdefault(isbn, {})[systemid] = {'status': 'Running', 'reserveurl': ''}
+                    continue
+                libkeys = {}
+                for library in self.libraries:
+                    if library['systemid'] == systemid:
+                        libkeys[library['libkey']] = check_statuses[sum((isbn + library['libkey']).encode('utf-8')) % len(check_statuses)]
+                books.setdefault(isbn, {})[systemid] = {'status': 'OK', 'reserveurl': '', 'libkey': libkeys}
+        return {'session': session['id'], 'continue': 1 if running else 0, 'books': books}
+
+
+def client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class FakeTable:
+    def __init__(self, db, name, keys):
+        self.db = db
+        self.name = name
+        self.keys = keys
+        self.items = {}
+
+    def key(self, item):
+        return tuple(item[k] for k in self.keys)
+
+    def check(self, item, condition, names, values):
+        # Conditions used by this bot: terms joined by OR, each attribute_not_exists(a) or a=:v
+        if condition is None:
+            return True
+        for term in condition.split(' OR '):
+            term = term.strip()
+            if term.startswith('attribute_not_exists('):
+                name = term[len('attribute_not_exists('):-1]
+                if item is None or names.get(name, name) not in item:
+                    return True
+            else:
+                name, value = (part.strip() for part in term.split('='))
+                if item is not None and item.get(names.get(name, name)) == values[value]:
+                    return True
+        return False
+
+    def get_item(self, Key, ConsistentRead=False):
+        self.db.count('GetItem')
+        item = self.items.get(self.key(Key))
+        return {} if item is None else {'Item': copy.deepcopy(item)}
+
+    def put_item(self, Item, ConditionExpression=None):
+        self.db.count('PutItem')
+        with self.db.lock:
+            if not self.check(self.items.get(self.key(Item)), ConditionExpression, {}, {}):
+                raise client_error('ConditionalCheckFailedException', 'PutItem')
+            self.items[self.key(Item)] = copy.deepcopy(Item)
+        return {}
+
+    def delete_item(self, Key):
+        self.db.count('DeleteItem')
+        with self.db.lock:
+            self.items.pop(self.key(Key), None)
+        return {}
+
+    def can_update(self, Key, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **kwargs):
+        return self.check(self.items.get(self.key(Key)), ConditionExpression, ExpressionAttributeNames or {}, ExpressionAttributeValues or {})
+
+    def apply_update(self, Key, UpdateExpression, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **kwargs):
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        item = self.items.setdefault(self.key(Key), copy.deepcopy(Key))
+        for assignment in UpdateExpression[len('set '):].split(','):
+            name, value = (part.strip() for part in assignment.split('='))
+            item[names.get(name, name)] = copy.deepcopy(values[value])
+
+    def update_item(self, **kwargs):
+        self.db.count('UpdateItem')
+        with self.db.lock:
+            if not self.can_update(**kwargs):
+                raise client_error('ConditionalCheckFailedException', 'UpdateItem')
+            self.apply_update(**kwargs)
+        return {}
+
+    def scan(self, **kwargs):
+        self.db.count('Scan')
+        return {'Items': [copy.deepcopy(item) for item in self.items.values()]}
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        table = self
+
+        class Batch:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                return False
+
+            def put_item(self, Item):
+                table.put_item(Item)
+
+            def delete_item(self, Key):
+                table.delete_item(Key)
+
+        return Batch()
+
+
+class FakeClient:
+    def __init__(self, db):
+        self.db = db
+
+    # All conditions are checked before any update is applied, like TransactWriteItems
+    def transact_write_items(self, TransactItems):
+        self.db.count('TransactWriteItems')
+        with self.db.lock:
+            updates = [dict(action['Update']) for action in TransactItems]
+            for update in updates:
+                if not self.db.tables[update.pop('TableName')].can_update(**update):
+                    raise client_error('TransactionCanceledException', 'TransactWriteItems')
+            for action, update in zip(TransactItems, updates):
+                self.db.tables[action['Update']['TableName']].apply_update(**update)
+        return {}
+
+
+# In-memory stand-in for the boto3 DynamoDB resource, covering the calls this bot makes
+class FakeDynamoDB:
+    def __init__(self):
+        self.tables = {}
+        self.calls = collections.Counter()
+        self.lock = threading.RLock()
+        self.meta = types.SimpleNamespace(client=FakeClient(self))
+
+    def create_table(self, name, keys):
+        self.tables[name] = FakeTable(self, name, keys)
+        return self.tables[name]
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def count(self, name):
+        with self.lock:
+            self.calls['dynamodb ' + name] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return collections.Counter(self.calls)
+
+    def batch_get_item(self, RequestItems):
+        self.count('BatchGetItem')
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.tables[name]
+            responses[name] = [copy.deepcopy(table.items[table.key(key)]) for key in request['Keys'] if table.key(key) in table.items]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
@@ -0,0 +1,203 @@
+import os
+import sys
+import logging
+import json
+
+import argparse
+import base64
+import hashlib
+import hmac
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+import fakes
+
+# Replays the recorded webhook deliveries in fixtures/ through lambda_handler against local stand-ins
+# of Calil, the LINE Messaging API and DynamoDB, and reports latency, upstream calls and peak memory.
+#
+#   python benchmark/run.py [--iterations 50] [--continue-rounds 2] [--calil-delay 0.05] [scenario ...]
+
+here = os.path.dirname(os.path.abspath(__file__))
+fixtures_dir = os.path.join(here, 'fixtures')
+
+channel_secret = 'benchmark'
+table_name = 'users'
+library_table_name = 'libraries'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline benchmark of lambda_handler')
+    parser.add_argument('scenarios', nargs='*', help='fixture names (default: all)')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=1, help='runs per scenario left out of the results')
+    parser.add_argument('--continue-rounds', type=int, default=1, help="polls a /check session answers 'continue': 1")
+    parser.add_argument('--calil-delay', type=float, default=0.02, help='seconds per Calil request')
+    parser.add_argument('--line-delay', type=float, default=0.005, help='seconds per LINE request')
+    parser.add_argument('--poll-interval', type=float, default=0.05, help='Calil poll interval (2s in production)')
+    parser.add_argument('--calil-rate', default='1000', help='cluster-wide Calil requests per second')
+    parser.add_argument('--full-records', action='store_true', help='store full library records in user rows (no library table)')
+    parser.add_argument('--warm-cache', action='store_true', help='keep the Calil caches between runs')
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args()
+
+
+# JPEG of an EAN-13 barcode on a gray background, standing in for a photo of a book
+def barcode_image(code='9784834000825'):
+    import numpy as np
+    import cv2
+
+    l_codes = ['0001101', '0011001', '0010011', '0111101', '0100011', '0110001', '0101111', '0111011', '0110111', '0001011']
+    r_codes = [''.join('1' if b == '0' else '0' for b in c) for c in l_codes]
+    g_codes = [c[::-1] for c in r_codes]
+    parity = ['LLLLLL', 'LLGLGG', 'LLGGLG', 'LLGGGL', 'LGLLGG', 'LGGLLG', 'LGGGLL', 'LGLGLG', 'LGLGGL', 'LGGLGL'][int(code[0])]
+
+    bits = '0' * 11 + '101'
+    for digit, side in zip(code[1:7], parity):
+        bits += (l_codes if side == 'L' else g_codes)[int(digit)]
+    bits += '01010'
+    for digit in code[7:]:
+        bits += r_codes[int(digit)]
+    bits += '101' + '0' * 11
+
+    row = np.array([0 if b == '1' else 255 for b in bits], dtype=np.uint8).repeat(4)
+    bars = np.tile(row, (240, 1))
+    img = np.full((1200, 1600), 160, dtype=np.uint8)
+    y, x = 480, (1600 - bars.shape[1]) // 2
+    img[y:y+bars.shape[0], x:x+bars.shape[1]] = bars
+    return cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+def load_scenarios(names):
+    scenarios = {}
+    for file_name in sorted(os.listdir(fixtures_dir)):
+        name, ext = os.path.splitext(file_name)
+        if ext == '.json' and (len(names) == 0 or name in names):
+            with open(os.path.join(fixtures_dir, file_name), encoding='utf-8') as f:
+                scenarios[name] = json.load(f)
+    return scenarios
+
+
+# Users in fixtures refer to libraries by libid. Rows hold libids like the handler writes them,
+# or full records with --full-records.
+def user_items(scenario, libraries, full_records):
+    by_libid = {library['libid']: library for library in libraries}
+    items = []
+    for user_id, user in scenario['users'].items():
+        item = {'userId': user_id, 'version': 1}
+        for field in ('libraries', 'favorites'):
+            libids = user.get(field, [])
+            item[field] = [by_libid[libid] for libid in libids] if full_records else list(libids)
+        items.append(item)
+    return items
+
+
+# Webhook delivery with fresh event ids and reply tokens, signed like LINE does
+def delivery(scenario):
+    body = json.loads(json.dumps(scenario['body']))
+    for event_data in body['events']:
+        event_data['webhookEventId'] = uuid.uuid4().hex
+        if 'replyToken' in event_data:
+            event_data['replyToken'] = uuid.uuid4().hex
+    body = json.dumps(body, ensure_ascii=False)
+    signature = base64.b64encode(hmac.new(channel_secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()).decode('utf-8')
+    return {'headers': {'x-line-signature': signature}, 'body': body}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def main():
+    args = parse_args()
+    with open(os.path.join(here, 'libraries.json'), encoding='utf-8') as f:
+        libraries = json.load(f)
+    scenarios = load_scenarios(args.scenarios)
+
+    # The image is only built (with numpy and cv2) when an image scenario runs
+    image = barcode_image() if 'image' in scenarios else b''
+    upstream = fakes.Upstream(libraries, image, args.continue_rounds, args.calil_delay, args.line_delay)
+    base_url = upstream.start()
+
+    # The handler reads its configuration at import time
+    os.environ.update({
+        'LINE_CHANNEL_SECRET': channel_secret,
+        'LINE_CHANNEL_ACCESS_TOKEN': 'benchmark',
+        'CALIL_APPKEY': 'benchmark',
+        'CALIL_BASE_URL': base_url,
+        'LINE_API_BASE_URL': base_url,
+        'LINE_DATA_BASE_URL': base_url,
+        'LIBRARY_SNAPSHOT': os.path.join(tempfile.gettempdir(), 'benchmark-no-snapshot.npz'),
+        'PROCESSING_MODE': 'inline',
+        'CALIL_RATE': args.calil_rate,
+        'METRICS_SAMPLE_RATE': os.getenv('METRICS_SAMPLE_RATE', '0'),
+        'Region': 'local',
+        'TableName': table_name
+    })
+    for name in ('CacheTableName', 'DedupTableName', 'WatchTableName', 'RateLimitTableName', 'LibraryTableName', 'SnapshotBucket'):
+        os.environ.pop(name, None)
+    if not args.full_records:
+        os.environ['LibraryTableName'] = library_table_name
+    sys.path.insert(0, os.path.dirname(here))
+
+    start = time.perf_counter()
+    import lambda_function
+    import aws
+    import calil
+    import_ms = (time.perf_counter() - start) * 1000
+
+    db = fakes.FakeDynamoDB()
+    table = db.create_table(table_name, ['userId'])
+    library_table = db.create_table(library_table_name, ['libid'])
+    library_table.items = {(library['libid'],): library for library in libraries}
+    aws.resources['dynamodb'] = db
+    calil.poll_interval = args.poll_interval
+    logging.getLogger().setLevel(args.log_level)
+
+    def run_once(scenario):
+        table.items = {(item['userId'],): item for item in user_items(scenario, libraries, args.full_records)}
+        if not args.warm_cache:
+            calil.availability_cache.clear()
+            calil.library_cache.clear()
+        event = delivery(scenario)
+        t = time.perf_counter()
+        response = lambda_function.lambda_handler(event, None)
+        elapsed = time.perf_counter() - t
+        if response['statusCode'] != 200:
+            raise RuntimeError('Handler returned ' + str(response['statusCode']))
+        return elapsed
+
+    print('import lambda_function: %.1f ms' % import_ms)
+    print('continue rounds: %d, Calil delay: %.0f ms, LINE delay: %.0f ms, poll interval: %.0f ms, cache: %s' % (
+        args.continue_rounds, args.calil_delay * 1000, args.line_delay * 1000, args.poll_interval * 1000, 'warm' if args.warm_cache else 'cold'))
+    print()
+    print('%-16s %6s %9s %9s %9s %11s  %s' % ('scenario', 'runs', 'p50 ms', 'p95 ms', 'max ms', 'peak KiB', 'calls per run'))
+
+    for name, scenario in scenarios.items():
+        for i in range(args.warmup):
+            run_once(scenario)
+
+        calls_before = upstream.snapshot() + db.snapshot()
+        latencies = [run_once(scenario) for i in range(args.iterations)]
+        calls = upstream.snapshot() + db.snapshot()
+        calls.subtract(calls_before)
+
+        # Memory is traced in a separate run, tracemalloc slows everything down.
+        # Allocations made inside OpenCV are not seen by it.
+        tracemalloc.start()
+        run_once(scenario)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        per_run = ', '.join('%s %.1f' % (k, v / args.iterations) for k, v in sorted(calls.items()) if v != 0)
+        print('%-16s %6d %9.1f %9.1f %9.1f %11.1f  %s' % (
+            name, len(latencies), percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+            max(latencies) * 1000, peak / 1024, per_run))
+
+    upstream.stop()
+
+
+if __name__ == '__main__':
+    main()
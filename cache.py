@@ -0,0 +1,170 @@
+import logging
+import json
+
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import aws
+
+logger = logging.getLogger()
+
+# Background refreshes of stale entries. Threads frozen with the Lambda container resume on the next invocation.
+refresh_executor = ThreadPoolExecutor(max_workers=4)
+
+# DynamoDB limit of BatchGetItem keys per request
+batch_get_size = 100
+
+
+class TTLCache:
+    def __init__(self, ttl, stale_ttl=0, maxsize=1024, store=None):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.maxsize = maxsize
+        self.store = store
+        self.entries = OrderedDict()  # key -> (value, expires)
+        self.loading = {}  # key -> Future of the load in flight
+        self.lock = threading.Lock()
+
+    # Returns (value, 'fresh' | 'stale' | None)
+    def lookup(self, key):
+        return self.lookup_many([key])[key]
+
+    # {key: (value, state)}. Keys missing here are read from the store in one batch,
+    # a store that cannot be read is logged and treated as a miss.
+    def lookup_many(self, keys):
+        now = time.time()
+        entries = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    entries[key] = entry
+        missing = [key for key in keys if key not in entries]
+        if len(missing) != 0 and self.store is not None:
+            try:
+                stored = self.store.get_many(missing)
+            except Exception:
+                logger.exception('Cache store read failed')
+                stored = {}
+            for key, entry in stored.items():
+                self.put(key, entry[0], entry[1])
+                entries[key] = entry
+        return {key: self.resolve(key, entries.get(key), now) for key in keys}
+
+    def resolve(self, key, entry, now):
+        if entry is None:
+            return None, None
+        value, expires = entry
+        if now < expires:
+            return value, 'fresh'
+        if now < expires + self.stale_ttl:
+            return value, 'stale'
+        with self.lock:
+            if self.entries.get(key) is entry:
+                del self.entries[key]
+        return None, None
+
+    # Drops the entries of this container, the persistent store is left as is
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def put(self, key, value, expires):
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        self.put(key, value, expires)
+        if self.store is not None:
+            try:
+                self.store.set(key, value, expires, expires + self.stale_ttl)
+            except Exception:
+                logger.exception('Cache store write failed: ' + key)
+
+    # Coalesces concurrent loads of one key: only the owner loads, the others wait on the future
+    def begin(self, key):
+        with self.lock:
+            future = self.loading.get(key)
+            if future is not None:
+                return future, False
+            future = Future()
+            self.loading[key] = future
+            return future, True
+
+    def finish(self, key, future, value, cacheable=True):
+        if cacheable:
+            self.set(key, value)
+        with self.lock:
+            if self.loading.get(key) is future:
+                del self.loading[key]
+        future.set_result(value)
+
+    def fail(self, key, future, exc):
+        with self.lock:
+            if self.loading.get(key) is future:
+                del self.loading[key]
+        future.set_exception(exc)
+
+    def get_or_load(self, key, loader):
+        value, state = self.lookup(key)
+        if state == 'fresh':
+            return value
+        future, owner = self.begin(key)
+        if state == 'stale':
+            if owner:
+                refresh_executor.submit(self.load, key, future, loader)
+            return value
+        if owner:
+            self.load(key, future, loader)
+        return future.result()
+
+    def load(self, key, future, loader):
+        try:
+            value = loader()
+        except Exception as e:
+            logger.exception('Cache load failed: ' + str(key))
+            self.fail(key, future, e)
+            return
+        self.finish(key, future, value)
+
+
+# Persistent tier shared by all containers. Items expire through the table's DynamoDB TTL on the 'ttl' attribute.
+class DynamoDBStore:
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    # {key: (value, expires)} of the keys found, with BatchGetItem
+    def get_many(self, keys):
+        found = {}
+        now = time.time()
+        keys = list(dict.fromkeys(keys))
+        for i in range(0, len(keys), batch_get_size):
+            request = {self.table_name: {'Keys': [{'cacheKey': key} for key in keys[i:i+batch_get_size]]}}
+            while len(request) != 0:
+                response = aws.resource('dynamodb').batch_get_item(RequestItems = request)
+                for item in response['Responses'].get(self.table_name, []):
+                    if int(item['ttl']) >= now:
+                        found[item['cacheKey']] = json.loads(item['value']), float(item['expires'])
+                request = response.get('UnprocessedKeys', {})
+        return found
+
+    def set(self, key, value, expires, ttl):
+        aws.table(self.table_name).put_item(Item = {
+            'cacheKey': key,
+            'value': json.dumps(value, ensure_ascii=False),
+            'expires': str(expires),
+            'ttl': int(ttl)
+        })
+
+
+def dynamodb_store(table_name):
+    if table_name is None:
+        return None
+    return DynamoDBStore(table_name)
@@ -0,0 +1,283 @@
+import os
+import logging
+
+import urllib.parse
+
+import asyncio
+
+import cache
+import calil_model
+import http_client
+import metrics
+import rate_limit
+import geo
+
+logger = logging.getLogger()
+
+# Overridable so that the benchmark can run against a local stand-in
+base_url = os.getenv('CALIL_BASE_URL', 'https://api.calil.jp')
+library_url = base_url + '/library'
+check_url = base_url + '/check'
+
+# Calil asks clients to wait a couple of seconds between polls of one session.
+# The interval is reset while libraries keep finishing and backs off while nothing changes.
+poll_interval = 2.0
+poll_interval_max = 8.0
+poll_backoff = 1.5
+
+# Overall time allowed for a /check session before partial results are returned
+check_deadline = float(os.getenv('CALIL_CHECK_DEADLINE', '20'))
+
+# Per (isbn, systemid) libkey status maps. Stale entries are served while a refresh runs in the background.
+availability_cache = cache.TTLCache(
+    ttl=float(os.getenv('CALIL_CACHE_TTL', '300')),
+    stale_ttl=float(os.getenv('CALIL_CACHE_STALE_TTL', '1800')),
+    maxsize=int(os.getenv('CALIL_CACHE_SIZE', '4096')),
+    store=cache.dynamodb_store(os.getenv('CacheTableName', None))
+)
+
+# Nearby libraries are cached per geohash tile and limit. A tile is fetched around its center with
+# extra results so that the libraries can be re-ranked by exact distance for any user inside the tile.
+library_tile_precision = int(os.getenv('CALIL_LIBRARY_TILE_PRECISION', '6'))
+library_overfetch = 2
+library_cache = cache.TTLCache(
+    ttl=float(os.getenv('CALIL_LIBRARY_CACHE_TTL', '86400')),
+    maxsize=int(os.getenv('CALIL_LIBRARY_CACHE_SIZE', '1024')),
+    store=cache.dynamodb_store(os.getenv('CacheTableName', None))
+)
+
+
+# Every request waits for the cluster-wide rate limit first, rate_limit.RateLimited when no token came in time
+def fetch_json(url, priority='interactive', timeout=None):
+    if not rate_limit.acquire(priority, timeout):
+        raise rate_limit.RateLimited(url)
+    with metrics.timer('calil_request'):
+        res = http_client.get(url)
+    logger.debug(res.body)
+    return res.json()
+
+
+# With session an earlier poll is resumed instead of asking for isbn and systemids again
+async def poll_check(isbn, systemids, deadline, priority='interactive', session=None):
+    loop = asyncio.get_running_loop()
+    appkey = os.getenv('CALIL_APPKEY', None)
+
+    if session is not None:
+        result = calil_model.Availability({}, session, more=True)
+    else:
+        query = urllib.parse.urlencode({
+            'appkey': appkey,
+            'isbn': isbn,
+            'systemid': systemids,
+            'format': 'json',
+            'callback': 'no'
+        })
+        try:
+            result = calil_model.Availability.parse(await loop.run_in_executor(None, metrics.bind(fetch_json), check_url + '?' + query, priority, deadline - loop.time()))
+        except rate_limit.RateLimited:
+            # Nothing was asked, the systems are reported as still running
+            return calil_model.Availability({}, more=True)
+    finished = result.finished()
+    interval = poll_interval
+
+    while result.more:
+        if loop.time() + interval > deadline:
+            logger.info('Calil check deadline exceeded: ' + isbn)
+            break
+        await asyncio.sleep(interval)
+        metrics.count('calil_poll_rounds')
+
+        session = result.session
+        query = urllib.parse.urlencode({
+            'appkey': appkey,
+            'session': session or '',
+            'format': 'json',
+            'callback': 'no'
+        })
+        try:
+            result = calil_model.Availability.parse(await loop.run_in_executor(None, metrics.bind(fetch_json), check_url + '?' + query, priority, deadline - loop.time()))
+        except rate_limit.RateLimited:
+            break
+        # Kept so that a poll cut short by the deadline can be resumed later
+        result.session = result.session or session
+
+        # Poll again soon while libraries keep answering, slow down while they do not
+        now_finished = result.finished()
+        if now_finished > finished:
+            interval = poll_interval
+        else:
+            interval = min(interval * poll_backoff, poll_interval_max)
+        finished = now_finished
+
+    return result
+
+
+def fetch_libraries(lat, lng, limit):
+    appkey = os.getenv('CALIL_APPKEY', None)
+    query = urllib.parse.urlencode({
+        'appkey': appkey,
+        'geocode': str(lng) + ',' + str(lat),
+        'format': 'json',
+        'callback': '',
+        'limit': limit
+    })
+    return calil_model.parse_libraries(fetch_json(library_url + '?' + query))
+
+
+def library_distance(library, lat, lng):
+    library_lng, library_lat = library['geocode'].split(',')
+    return geo.distance(lat, lng, float(library_lat), float(library_lng))
+
+
+def nearby_libraries(lat, lng, limit):
+    tile = geo.geohash(lat, lng, library_tile_precision)
+    tile_lat, tile_lng = geo.geohash_center(tile)
+    libraries = library_cache.get_or_load(
+        'library:' + tile + ':' + str(limit),
+        lambda: fetch_libraries(tile_lat, tile_lng, limit * library_overfetch)
+    )
+    return sorted(libraries, key=lambda library: library_distance(library, lat, lng))[:limit]
+
+
+def availability_key(isbn, systemid):
+    return 'check:' + isbn + ':' + systemid
+
+
+# owned: {(isbn, systemid): future}. One Calil session covers all ISBNs and systemids of the pairs.
+# The cache holds the JSON form of each calil_model.System so that it can be stored in DynamoDB.
+# Returns the systems and the session.
+async def fetch_availability(owned, deadline, priority='interactive'):
+    isbns = list(dict.fromkeys(isbn for isbn, systemid in owned))
+    systemids = list(dict.fromkeys(systemid for isbn, systemid in owned))
+    try:
+        result = await poll_check(','.join(isbns), ','.join(systemids), deadline, priority)
+    except BaseException as e:
+        # Requests waiting on these keys are released whatever stopped the poll, cancellation included
+        error = e if isinstance(e, Exception) else RuntimeError('Calil check cancelled')
+        for (isbn, systemid), future in owned.items():
+            availability_cache.fail(availability_key(isbn, systemid), future, error)
+        raise
+    fetched = {}
+    for (isbn, systemid), future in owned.items():
+        system = result.system(isbn, systemid) or calil_model.System('Running' if result.more else 'Error')
+        fetched[(isbn, systemid)] = system
+        availability_cache.finish(availability_key(isbn, systemid), future, system.to_json(), system.cacheable)
+    return fetched, result.session
+
+
+async def refresh_availability(owned):
+    await fetch_availability(owned, asyncio.get_running_loop().time() + check_deadline, 'background')
+
+
+def run_refresh(owned):
+    try:
+        asyncio.run(refresh_availability(owned))
+    except Exception:
+        logger.exception('Calil availability refresh failed')
+
+
+async def check_availability(isbns, systemids, deadline, priority='interactive'):
+    loop = asyncio.get_running_loop()
+    systems = {}
+    owned = {}
+    waiting = {}
+    refreshing = {}
+
+    pairs = [(isbn, systemid) for isbn in dict.fromkeys(isbns) for systemid in dict.fromkeys(systemids.split(','))]
+    # One batch read of the persistent tier for all pairs, off the event loop
+    cached = await loop.run_in_executor(None, metrics.bind(availability_cache.lookup_many), [availability_key(isbn, systemid) for isbn, systemid in pairs])
+
+    for isbn, systemid in pairs:
+        key = availability_key(isbn, systemid)
+        value, state = cached[key]
+        if state is not None:
+            systems[(isbn, systemid)] = calil_model.System.parse(value)
+            if state == 'stale':
+                future, owner = availability_cache.begin(key)
+                if owner:
+                    refreshing[(isbn, systemid)] = future
+            continue
+        future, owner = availability_cache.begin(key)
+        if owner:
+            owned[(isbn, systemid)] = future
+        else:
+            waiting[(isbn, systemid)] = future
+
+    if len(refreshing) != 0:
+        cache.refresh_executor.submit(run_refresh, refreshing)
+
+    session = None
+    if len(owned) != 0:
+        fetched, session = await fetch_availability(owned, deadline, priority)
+        systems.update(fetched)
+
+    # Another request is already asking Calil for these systems
+    for pair, future in waiting.items():
+        try:
+            systems[pair] = calil_model.System.parse(await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), max(0, deadline - loop.time())))
+        except Exception:
+            systems[pair] = calil_model.System('Running')
+
+    # The session can be resumed only when it covers every system still running
+    if any(systems[pair].running for pair in waiting):
+        session = None
+    return calil_model.Availability(systems, session)
+
+
+# Polls the session of an earlier check until the running systems finish. Without a session they are asked again.
+async def resume_availability(isbn, systemids, session, deadline, priority='interactive'):
+    if session is None:
+        return await check_availability([isbn], systemids, deadline, priority)
+    result = await poll_check(isbn, systemids, deadline, priority, session)
+    systems = {}
+    for systemid in dict.fromkeys(systemids.split(',')):
+        system = result.system(isbn, systemid) or calil_model.System('Running' if result.more else 'Error')
+        systems[(isbn, systemid)] = system
+        if system.cacheable:
+            availability_cache.set(availability_key(isbn, systemid), system.to_json())
+    return calil_model.Availability(systems, result.session)
+
+
+# Every query runs to the end even when another one fails, so that none is cancelled while it owns cache keys.
+# With return_exceptions the exception of a failed query takes its place, otherwise the first one is raised.
+def gather_results(results, return_exceptions):
+    if not return_exceptions:
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+    return results
+
+
+async def poll_checks(queries, timeout, priority):
+    deadline = asyncio.get_running_loop().time() + timeout
+    return await asyncio.gather(*[check_availability(isbns, systemids, deadline, priority) for isbns, systemids in queries], return_exceptions=True)
+
+
+def check_many(queries, timeout=None, priority='interactive', return_exceptions=False):
+    # queries: list of ([isbn, ...], comma separated systemids), calil_model.Availability for each in the same order
+    if len(queries) == 0:
+        return []
+    with metrics.timer('calil_check'):
+        return gather_results(asyncio.run(poll_checks(queries, check_deadline if timeout is None else timeout, priority)), return_exceptions)
+
+
+async def poll_resumes(queries, timeout, priority):
+    deadline = asyncio.get_running_loop().time() + timeout
+    return await asyncio.gather(*[resume_availability(isbn, systemids, session, deadline, priority) for isbn, systemids, session in queries], return_exceptions=True)
+
+
+def resume_many(queries, timeout=None, priority='interactive', return_exceptions=False):
+    # queries: list of (isbn, comma separated systemids, session or None), calil_model.Availability for each in the same order
+    if len(queries) == 0:
+        return []
+    with metrics.timer('calil_resume'):
+        return gather_results(asyncio.run(poll_resumes(queries, check_deadline if timeout is None else timeout, priority)), return_exceptions)
+
+
+def check(isbn, systemids, timeout=None):
+    return check_many([([isbn], systemids)], timeout)[0]
+
+
+# Several ISBNs in one Calil session
+def check_bulk(isbns, systemids, timeout=None):
+    return check_many([(isbns, systemids)], timeout)[0]
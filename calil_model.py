@@ -0,0 +1,87 @@
+# Calil payloads parsed once into compact objects. Lookups afterwards are dictionary accesses,
+# and missing or malformed parts of a payload are treated as unknown instead of failing.
+
+# Fields of a /library entry the bot uses, the rest of the payload is dropped
+library_fields = ['libid', 'systemid', 'libkey', 'short', 'formal', 'address', 'geocode']
+
+
+def parse_libraries(payload):
+    if not isinstance(payload, list):
+        return []
+    libraries = []
+    for entry in payload:
+        if isinstance(entry, dict) and all(field in entry for field in library_fields):
+            libraries.append({field: entry[field] for field in library_fields})
+    return libraries
+
+
+# /check result of one (isbn, systemid)
+class System:
+    __slots__ = ('status', 'reserveurl', 'libkeys')
+
+    def __init__(self, status, reserveurl='', libkeys=None):
+        self.status = status
+        self.reserveurl = reserveurl
+        self.libkeys = libkeys or {}
+
+    @classmethod
+    def parse(cls, data):
+        if not isinstance(data, dict):
+            return cls('Error')
+        libkeys = data.get('libkey')
+        return cls(data.get('status') or 'Error', data.get('reserveurl') or '', libkeys if isinstance(libkeys, dict) else {})
+
+    # Form kept in the availability cache
+    def to_json(self):
+        return {'status': self.status, 'reserveurl': self.reserveurl, 'libkey': self.libkeys}
+
+    @property
+    def running(self):
+        return self.status == 'Running'
+
+    # Only finished lookups are cached, 'Running' (deadline exceeded) and 'Error' are asked again next time
+    @property
+    def cacheable(self):
+        return self.status in ('OK', 'Cache')
+
+
+# Results of one /check poll, or of several merged. statuses indexes every libkey by (isbn, systemid, libkey).
+class Availability:
+    __slots__ = ('systems', 'statuses', 'session', 'more')
+
+    def __init__(self, systems, session=None, more=None):
+        self.systems = systems
+        self.statuses = {}
+        for (isbn, systemid), system in systems.items():
+            for libkey, status in system.libkeys.items():
+                self.statuses[(isbn, systemid, libkey)] = status
+        self.session = session
+        self.more = self.running if more is None else more
+
+    @classmethod
+    def parse(cls, payload):
+        if not isinstance(payload, dict):
+            payload = {}
+        systems = {}
+        books = payload.get('books')
+        for isbn, by_system in (books if isinstance(books, dict) else {}).items():
+            for systemid, data in (by_system if isinstance(by_system, dict) else {}).items():
+                systems[(isbn, systemid)] = System.parse(data)
+        return cls(systems, payload.get('session'), str(payload.get('continue', 0)) == '1')
+
+    def system(self, isbn, systemid):
+        return self.systems.get((isbn, systemid))
+
+    def status(self, isbn, systemid, libkey):
+        return self.statuses.get((isbn, systemid, libkey))
+
+    def is_running(self, isbn, systemid):
+        system = self.systems.get((isbn, systemid))
+        return system is not None and system.running
+
+    @property
+    def running(self):
+        return any(system.running for system in self.systems.values())
+
+    def finished(self):
+        return sum(1 for system in self.systems.values() if not system.running)
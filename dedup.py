@@ -0,0 +1,77 @@
+import os
+import logging
+
+import time
+
+import aws
+import cache
+
+logger = logging.getLogger()
+
+dedup_ttl = int(os.getenv('DEDUP_TTL', '86400'))
+
+# Events already handled by this container
+seen = cache.TTLCache(ttl=dedup_ttl, maxsize=int(os.getenv('DEDUP_CACHE_SIZE', '10000')))
+
+table_name = os.getenv('DedupTableName', None)
+
+
+# Records the event before any work is done. Returns False when it was already claimed
+# here or by another container (conditional put keyed by webhookEventId, expired by DynamoDB TTL).
+def claim(event_data):
+    event_id = event_data.get('webhookEventId')
+    if event_id is None:
+        return True
+    value, state = seen.lookup(event_id)
+    if state is not None:
+        return False
+    # Marked as seen only once the claim is stored, an event whose put failed is not a duplicate
+    if table_name is not None:
+        try:
+            aws.table(table_name).put_item(
+                Item = {
+                    'webhookEventId': event_id,
+                    'ttl': int(time.time()) + dedup_ttl
+                },
+                ConditionExpression = 'attribute_not_exists(webhookEventId)'
+            )
+        except Exception as e:
+            if aws.error_code(e) != 'ConditionalCheckFailedException':
+                raise
+            seen.set(event_id, True)
+            return False
+    seen.set(event_id, True)
+    return True
+
+
+# Forgets a claimed event whose processing failed so that a redelivery is handled again
+def release(event_data):
+    event_id = event_data.get('webhookEventId')
+    if event_id is None:
+        return
+    seen.set(event_id, True, ttl=0)
+    if table_name is not None:
+        aws.table(table_name).delete_item(Key = {'webhookEventId': event_id})
+
+
+# Releases each event even when another release fails, the errors are logged
+def release_all(events):
+    for event_data in events:
+        try:
+            release(event_data)
+        except Exception:
+            logger.exception('Event release failed: ' + str(event_data.get('webhookEventId')))
+
+
+def filter_new(events):
+    new_events = []
+    try:
+        for event_data in events:
+            if claim(event_data):
+                new_events.append(event_data)
+            else:
+                logger.info('Duplicate event: ' + event_data['webhookEventId'])
+    except Exception:
+        release_all(new_events)
+        raise
+    return new_events
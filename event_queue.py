@@ -0,0 +1,132 @@
+import os
+import logging
+import json
+
+import sqlite3
+import contextlib
+import threading
+import time
+import uuid
+from collections import deque
+
+import aws
+
+logger = logging.getLogger()
+
+visibility_timeout = 60
+
+
+# Amazon SQS. With a FIFO queue the events of one user keep their order (MessageGroupId = userId).
+class SQSQueue:
+    batch_size = 10
+
+    def __init__(self, url):
+        self.url = url
+        self.fifo = url.endswith('.fifo')
+        self.sqs = aws.client('sqs')
+
+    def enqueue(self, events):
+        for i in range(0, len(events), self.batch_size):
+            entries = []
+            for j, event_data in enumerate(events[i:i+self.batch_size]):
+                entry = {
+                    'Id': str(j),
+                    'MessageBody': json.dumps(event_data, ensure_ascii=False)
+                }
+                if self.fifo:
+                    entry['MessageGroupId'] = event_data.get('source', {}).get('userId', 'none')
+                    entry['MessageDeduplicationId'] = event_data.get('webhookEventId', str(uuid.uuid4()))
+                entries.append(entry)
+            response = self.sqs.send_message_batch(QueueUrl = self.url, Entries = entries)
+            if len(response.get('Failed', [])) != 0:
+                raise RuntimeError('SQS enqueue failed: ' + json.dumps(response['Failed']))
+
+    def receive(self, max_count):
+        response = self.sqs.receive_message(
+            QueueUrl = self.url,
+            MaxNumberOfMessages = min(max_count, self.batch_size),
+            VisibilityTimeout = visibility_timeout
+        )
+        return [(message['ReceiptHandle'], json.loads(message['Body'])) for message in response.get('Messages', [])]
+
+    def delete(self, handles):
+        for i in range(0, len(handles), self.batch_size):
+            self.sqs.delete_message_batch(
+                QueueUrl = self.url,
+                Entries = [{'Id': str(j), 'ReceiptHandle': handle} for j, handle in enumerate(handles[i:i+self.batch_size])]
+            )
+
+
+# Local stand-in backed by a SQLite file, shared between processes on one machine
+class SQLiteQueue:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        with self.transaction() as db:
+            db.execute('create table if not exists events (id integer primary key autoincrement, body text not null, visible_at real not null)')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock, contextlib.closing(sqlite3.connect(self.path, timeout=30, isolation_level=None)) as db:
+            db.execute('begin immediate')
+            try:
+                yield db
+            except Exception:
+                db.execute('rollback')
+                raise
+            db.execute('commit')
+
+    def enqueue(self, events):
+        with self.transaction() as db:
+            db.executemany('insert into events (body, visible_at) values (?, 0)', [(json.dumps(event_data, ensure_ascii=False),) for event_data in events])
+
+    def receive(self, max_count):
+        now = time.time()
+        with self.transaction() as db:
+            rows = db.execute('select id, body from events where visible_at <= ? order by id limit ?', (now, max_count)).fetchall()
+            db.executemany('update events set visible_at = ? where id = ?', [(now + visibility_timeout, row[0]) for row in rows])
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def delete(self, handles):
+        with self.transaction() as db:
+            db.executemany('delete from events where id = ?', [(handle,) for handle in handles])
+
+
+# In-process queue for tests and the local server
+class MemoryQueue:
+    def __init__(self):
+        self.events = deque()
+        self.lock = threading.Lock()
+
+    def enqueue(self, events):
+        with self.lock:
+            self.events.extend(events)
+
+    def receive(self, max_count):
+        with self.lock:
+            received = []
+            while len(self.events) != 0 and len(received) < max_count:
+                received.append((None, self.events.popleft()))
+            return received
+
+    def delete(self, handles):
+        pass
+
+
+queue = None
+
+
+# EVENT_QUEUE selects the backend: 'sqs' (EventQueueUrl), 'sqlite' (EVENT_QUEUE_PATH) or 'memory'
+def get_queue():
+    global queue
+    if queue is None:
+        backend = os.getenv('EVENT_QUEUE', 'sqs')
+        if backend == 'sqs':
+            queue = SQSQueue(os.environ['EventQueueUrl'])
+        elif backend == 'sqlite':
+            queue = SQLiteQueue(os.getenv('EVENT_QUEUE_PATH', '/tmp/events.sqlite3'))
+        elif backend == 'memory':
+            queue = MemoryQueue()
+        else:
+            raise ValueError('Unknown EVENT_QUEUE: ' + backend)
+    return queue
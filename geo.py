@@ -0,0 +1,65 @@
+import math
+
+base32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash(lat, lng, precision):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    code = ''
+    bits = 0
+    ch = 0
+    even = True
+    while len(code) < precision:
+        if even:
+            mid = (lng_range[0] + lng_range[1]) / 2
+            if lng >= mid:
+                ch = ch * 2 + 1
+                lng_range[0] = mid
+            else:
+                ch = ch * 2
+                lng_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if lat >= mid:
+                ch = ch * 2 + 1
+                lat_range[0] = mid
+            else:
+                ch = ch * 2
+                lat_range[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            code += base32[ch]
+            bits = 0
+            ch = 0
+    return code
+
+
+# Returns the (lat, lng) center of a geohash tile
+def geohash_center(code):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    even = True
+    for c in code:
+        ch = base32.index(c)
+        for shift in range(4, -1, -1):
+            bit = (ch >> shift) & 1
+            target = lng_range if even else lat_range
+            mid = (target[0] + target[1]) / 2
+            if bit:
+                target[0] = mid
+            else:
+                target[1] = mid
+            even = not even
+    return (lat_range[0] + lat_range[1]) / 2, (lng_range[0] + lng_range[1]) / 2
+
+
+# Great-circle distance in kilometers
+def distance(lat1, lng1, lat2, lng2):
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(a))
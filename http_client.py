@@ -0,0 +1,208 @@
+import os
+import logging
+import json
+
+import http.client
+import urllib.parse
+
+import random
+import threading
+import time
+
+logger = logging.getLogger()
+
+default_timeout = float(os.getenv('HTTP_TIMEOUT', '10'))
+max_retry = int(os.getenv('HTTP_RETRIES', '2'))
+pool_size = int(os.getenv('HTTP_POOL_SIZE', '10'))
+
+retry_status = (429, 500, 502, 503, 504)
+backoff_base = 0.2
+backoff_max = 5.0
+
+# Errors of a kept-alive connection that the server closed while it was idle in the pool
+reset_errors = (http.client.RemoteDisconnected, http.client.CannotSendRequest, ConnectionResetError, BrokenPipeError)
+
+
+class HTTPError(Exception):
+    def __init__(self, status, reason, body):
+        super().__init__(str(status) + ' ' + reason)
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+# Keep-alive connections of one host, kept at module level so that they survive warm invocations
+class ConnectionPool:
+    def __init__(self, scheme, host, port):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self, timeout):
+        with self.lock:
+            if len(self.idle) != 0:
+                conn = self.idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        return self.connect(timeout), False
+
+    def connect(self, timeout):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def put(self, conn):
+        with self.lock:
+            if len(self.idle) < pool_size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(url):
+    key = (url.scheme, url.hostname, url.port)
+    with pools_lock:
+        pool = pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(url.scheme, url.hostname, url.port)
+            pools[key] = pool
+        return pool
+
+
+class Response:
+    def __init__(self, pool, conn, res):
+        self.pool = pool
+        self.conn = conn
+        self.res = res
+        self.status = res.status
+        self.reason = res.reason
+        self.headers = res.headers
+
+    def read(self, amt=None):
+        return self.res.read(amt)
+
+    def readinto(self, buffer):
+        return self.res.readinto(buffer)
+
+    def iter_content(self, chunk_size=65536):
+        while True:
+            chunk = self.res.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        if self.conn is None:
+            return
+        # The connection can only be reused once the body has been read to the end
+        if self.res.isclosed() and not self.res.will_close:
+            self.pool.put(self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BufferedResponse:
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def json(self, **kwargs):
+        return json.loads(self.body, **kwargs)
+
+
+def backoff(attempt, res):
+    retry_after = res.headers.get('Retry-After', '') if res is not None else ''
+    if retry_after.isdigit():
+        return min(float(retry_after), backoff_max)
+    # Full jitter
+    return random.uniform(0, min(backoff_max, backoff_base * (2 ** attempt)))
+
+
+def send(url, method, body, headers, request_timeout):
+    pool = get_pool(url)
+    path = url.path or '/'
+    if url.query:
+        path += '?' + url.query
+    conn, reused = pool.get(request_timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers)
+        res = conn.getresponse()
+    except reset_errors:
+        conn.close()
+        if not reused:
+            raise
+        # Try once more on a new connection when an idle connection was closed by the server
+        conn = pool.connect(request_timeout)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            res = conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
+    except Exception:
+        conn.close()
+        raise
+    return Response(pool, conn, res)
+
+
+# Sends a request on a pooled connection. 429/5xx and connection errors are retried with jittered backoff.
+# With stream=True the open Response is returned and must be closed by the caller.
+def request(method, url, body=None, headers=None, timeout=None, retries=None, stream=False):
+    url = urllib.parse.urlsplit(url)
+    request_timeout = default_timeout if timeout is None else timeout
+    retries = max_retry if retries is None else retries
+    headers = headers or {}
+
+    attempt = 0
+    while True:
+        try:
+            res = send(url, method, body, headers, request_timeout)
+        except (OSError, http.client.HTTPException) as e:
+            if attempt >= retries:
+                raise
+            logger.info('HTTP retry ' + url.hostname + ': ' + str(e))
+            time.sleep(backoff(attempt, None))
+            attempt += 1
+            continue
+
+        if res.status in retry_status and attempt < retries:
+            res.read()
+            res.close()
+            logger.info('HTTP retry ' + url.hostname + ': ' + str(res.status))
+            time.sleep(backoff(attempt, res))
+            attempt += 1
+            continue
+
+        if res.status >= 400:
+            with res:
+                raise HTTPError(res.status, res.reason, res.read())
+
+        if stream:
+            return res
+        with res:
+            return BufferedResponse(res.status, res.reason, res.headers, res.read())
+
+
+def get(url, headers=None, **kwargs):
+    return request('GET', url, headers=headers, **kwargs)
+
+
+def post(url, body, headers=None, **kwargs):
+    return request('POST', url, body=body, headers=headers, **kwargs)
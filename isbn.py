@@ -0,0 +1,76 @@
+import re
+
+# Full-width digits and separators users type or paste
+translation = str.maketrans('０１２３４５６７８９Ｘｘ－‐ー', '0123456789XX---')
+
+candidate = re.compile(r'^(\d{9}[\dX]|\d{13})$')
+
+
+def normalize(text):
+    return re.sub(r'[\s-]', '', text.translate(translation)).upper()
+
+
+# True for 10 or 13 character strings that are meant as an ISBN, valid or not
+def looks_like(text):
+    return candidate.match(normalize(text)) is not None
+
+
+def is_valid10(code):
+    if re.match(r'^\d{9}[\dX]$', code) is None:
+        return False
+    total = sum((10 - i) * int(c) for i, c in enumerate(code[:9]))
+    total += 10 if code[9] == 'X' else int(code[9])
+    return total % 11 == 0
+
+
+def check_digit13(code):
+    total = sum(int(c) * (1 if i % 2 == 0 else 3) for i, c in enumerate(code[:12]))
+    return str((10 - total % 10) % 10)
+
+
+def is_valid13(code):
+    return re.match(r'^\d{13}$', code) is not None and check_digit13(code) == code[12]
+
+
+# EAN-13 codes of books (Bookland 978/979). The second barcode on Japanese books (192...) is not one.
+def is_book(code):
+    return is_valid13(code) and code[:3] in ('978', '979')
+
+
+def to13(code):
+    if is_valid13(code):
+        return code
+    if not is_valid10(code):
+        return None
+    code13 = '978' + code[:9]
+    return code13 + check_digit13(code13)
+
+
+def to10(code):
+    if is_valid10(code):
+        return code
+    if not is_valid13(code) or code[:3] != '978':
+        return None
+    body = code[3:12]
+    check = (11 - sum((10 - i) * int(c) for i, c in enumerate(body)) % 11) % 11
+    return body + ('X' if check == 10 else str(check))
+
+
+# Canonical form used for lookups and cache keys: ISBN-13, or None when the input is not a valid ISBN
+def canonical(text):
+    code = to13(normalize(text))
+    if code is None or code[:3] not in ('978', '979'):
+        return None
+    return code
+
+
+def book_codes(codes):
+    return list(dict.fromkeys(code for code in codes if is_book(code)))
+
+
+# Splits a pasted list of ISBNs (commas, spaces or new lines). Returns None unless there are two or more ISBN-like items.
+def parse_list(text):
+    items = [item for item in re.split(r'[\s,、，]+', text.translate(translation)) if item != '']
+    if len(items) < 2 or not all(looks_like(item) for item in items):
+        return None
+    return items
@@ -1,3 +1,6 @@
+import time
+init_start = time.perf_counter()
+
 import os
 import sys
 import logging
@@ -7,18 +10,26 @@ import base64
 import hashlib
 import hmac
 
-import urllib.request, urllib.parse
-
-import re
-import time
-import boto3
-import decimal
+import urllib.parse
+import concurrent.futures
 
-import numpy as np
-import cv2
+import barcode
+import calil
+import dedup
+import event_queue
+import http_client
+import isbn
+import library_directory
+import library_records
+import line_api
+import messages
+import metrics
+import user_state
+import watchlist
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+# リクエストやレスポンスの本文はLOG_LEVEL=DEBUGのときだけ出力する
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
 
 # get channel_secret and channel_access_token from your environment variable
 channel_secret = os.getenv('LINE_CHANNEL_SECRET', None)
@@ -30,632 +41,546 @@ if channel_access_token is None:
     logger.error('Specify LINE_CHANNEL_ACCESS_TOKEN as environment variable.')
     sys.exit(1)
 
-dynamodb = boto3.resource('dynamodb', region_name=os.environ['Region'])
-table = dynamodb.Table(os.environ['TableName'])
+max_library = 8
 
-bd = cv2.barcode.BarcodeDetector()
+# まとめて調べる書籍の数(カルーセルの列の上限)
+max_bulk = 10
 
-max_library = 8
+# 並行して処理するユーザー数
+event_workers = int(os.getenv('EVENT_WORKERS', '4'))
+
+# inline: 受け取ったリクエストの中で処理する, queue: キューに積んでworker_handlerで処理する
+processing_mode = os.getenv('PROCESSING_MODE', 'inline')
+worker_batch_size = int(os.getenv('WORKER_BATCH_SIZE', '10'))
+
+# 1: 蔵書検索は最初の応答で分かった結果をすぐに返信し、確認中の図書館の結果は後でプッシュする
+# (プッシュメッセージは送信数の上限に数えられる)
+progressive_delivery = os.getenv('PROGRESSIVE_DELIVERY', '0') == '1'
+# 最初の返信までに待つ秒数
+first_result_wait = float(os.getenv('FIRST_RESULT_WAIT', '1.5'))
+# inline のとき、確認中の図書館はキューに積んでworker_handlerで確認する(それ以外は返信の後にその場で確認する)。
+# 既定ではSQSのときだけ。memory/sqlite のキューはworker_handlerを動かすもの(server.pyなど)がなければ処理されない
+followup_queue = os.getenv('FOLLOWUP_QUEUE', '1' if os.getenv('EVENT_QUEUE', 'sqs') == 'sqs' and os.getenv('EventQueueUrl') else '0') == '1'
+
+# numpy/cv2 and boto3 are loaded by the first event that needs them, not here
+logger.info('Init: ' + str(round((time.perf_counter() - init_start) * 1000, 1)) + 'ms')
 
 def lambda_handler(event, context):
-    logger.info(json.dumps(event))
+    with metrics.trace('webhook'):
+        return handle_webhook(event)
+
+
+def handle_webhook(event):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps(event))
     
     body = event.get('body', '')  # Request body string
-    hash = hmac.new(channel_secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
-    signature = base64.b64encode(hash).decode('utf-8')
+    with metrics.timer('signature'):
+        hash = hmac.new(channel_secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+        signature = base64.b64encode(hash).decode('utf-8')
     # Compare X-Line-Signature request header and the signature
     if signature != event.get('headers').get('X-Line-Signature', '') and signature != event.get('headers').get('x-line-signature', ''):
         logger.error('Validate Error')
         return {'statusCode': 403, 'body': '{}'}
     
-    for event_data in json.loads(body).get('events', []):
-        if event_data['type'] == 'follow':
-            table.put_item(Item = {
-                'userId': event_data['source']['userId'],
-                'libraries': [],
-                'favorites': []
-            })
-            continue
-        elif event_data['type'] == 'message':
-            response = table.get_item(Key = {'userId': event_data['source']['userId']})
-            favorites = response["Item"]['favorites']
-            
-            reply_item = [{
-                'type': 'action',
-                'action': {
-                    'type': 'message',
-                    'label': 'やめる',
-                    'text': 'やめる'
-                }
-            },
-            {
-                'type': 'action',
-                'action': {
-                    'type': 'message',
-                    'label': '図書館を探す',
-                    'text': '図書館を探す'
-                }
-            }]
+    events = json.loads(body).get('events', [])
+    
+    # キューに積んですぐに応答し、処理はworker_handlerで行う
+    if processing_mode == 'queue':
+        if len(events) != 0:
+            event_queue.get_queue().enqueue(events)
+        return {'statusCode': 200, 'body': '{}'}
+    
+    for group, e in process_events(events, followup_queue):
+        raise e
+    
+    return {'statusCode': 200, 'body': '{}'}
+
+
+# Entry point of the background worker. Invoked by the SQS event source with 'Records',
+# or without them to drain the configured queue (e.g. the SQLite stand-in) in batches.
+def worker_handler(event, context):
+    with metrics.trace('worker'):
+        return handle_worker(event)
+
+
+def handle_worker(event):
+    records = event.get('Records') if isinstance(event, dict) else None
+    if records is not None:
+        events = []
+        message_ids = {}
+        for record in records:
+            event_data = json.loads(record['body'])
+            events.append(event_data)
+            message_ids[id(event_data)] = record['messageId']
+        failures = []
+        for group, e in process_events(events):
+            logger.error('Event processing failed: ' + str(e))
+            failures += [{'itemIdentifier': message_ids[id(event_data)]} for event_data in group]
+        return {'batchItemFailures': failures}
+    
+    queue = event_queue.get_queue()
+    count = 0
+    while True:
+        received = queue.receive(worker_batch_size)
+        if len(received) == 0:
+            break
+        failed = set()
+        for group, e in process_events([event_data for handle, event_data in received]):
+            logger.error('Event processing failed: ' + str(e))
+            failed.update(id(event_data) for event_data in group)
+        # 失敗したイベントは可視性タイムアウト後に再処理される
+        queue.delete([handle for handle, event_data in received if id(event_data) not in failed])
+        count += len(received)
+    return {'count': count}
+
+
+# Returns (events, exception) for each user whose events failed: the failed event and the ones after it.
+# Those are released so that a redelivery handles them again, the events answered before them are not.
+def process_events(events, defer_followups=False):
+    # 再送されたイベントは重い処理を始める前に取り除く
+    events = dedup.filter_new(events)
+    
+    # 途中で例外になったときは、再送で処理し直せるようにすべてのイベントを解放する
+    try:
+        failures = process_new_events(events, defer_followups)
+    except Exception:
+        dedup.release_all(events)
+        raise
+    for group, e in failures:
+        dedup.release_all(group)
+    return failures
+
+
+def process_new_events(events, defer_followups):
+    # 1回の呼び出しで使うユーザー情報をまとめて読み込む
+    with metrics.timer('dynamodb_load'):
+        states = user_state.load_all(user_state.user_ids(events))
+    
+    # 画像の取得とバーコードの読み取りを並列に始める。待つのは画像のイベントだけ
+    image_executor, images = start_images(events)
+    
+    # 後でプッシュする検索 {userId: [(isbn13, 確認中の図書館, Calilのセッション), ...]}
+    followups = {}
+    
+    # ユーザーごとに順番を守りつつ、別々のユーザーのイベントは並行して処理する
+    groups = {}
+    for i, event_data in enumerate(events):
+        groups.setdefault(event_data.get('source', {}).get('userId', i), []).append(event_data)
+    
+    try:
+        if event_workers <= 1 or len(groups) <= 1:
+            results = [handle_events(group, states, images, followups) for group in groups.values()]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(event_workers, len(groups))) as executor:
+                futures = [executor.submit(metrics.bind(handle_events), group, states, images, followups) for group in groups.values()]
+            results = [future.result() for future in futures]
+    finally:
+        if image_executor is not None:
+            image_executor.shutdown(wait=False)
+    
+    with metrics.timer('dynamodb_write'):
+        user_state.flush_all(states)
+    
+    # 返信は済んでいるので、確認中だった図書館の結果をユーザーごとにまとめてプッシュする
+    if len(followups) != 0:
+        if defer_followups:
+            defer(followups)
+        else:
+            push_followups(followups)
+    
+    return [result for result in results if result is not None]
+
+
+# Returns the executor (None without images) and {message id: future of the decode result or the exception}
+def start_images(events):
+    message_ids = []
+    for event_data in events:
+        message = event_data.get('message', {})
+        if event_data['type'] == 'message' and message.get('type') == 'image' and message.get('contentProvider', {}).get('type') == 'line':
+            message_ids.append(message['id'])
+    message_ids = list(dict.fromkeys(message_ids))
+    if len(message_ids) == 0:
+        return None, {}
+    
+    # 1枚だけならプロセスプールを使わずにその場で読み取る
+    pooled = len(message_ids) > 1
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(event_workers, len(message_ids)))
+    return executor, {message_id: executor.submit(metrics.bind(load_image), message_id, pooled) for message_id in message_ids}
+
+
+def load_image(message_id, pooled):
+    # 画像ごとの失敗はそのイベントへの返信にして、他のイベントは止めない
+    try:
+        with metrics.timer('line_content'):
+            content = line_api.fetch_image(message_id)
+        result = barcode.decode_pooled(content) if pooled else barcode.decode(content)
+    except Exception as e:
+        return e
+    # デコードは別プロセスのこともあるので、計測値は結果から記録する
+    found, codes, timings = result
+    metrics.record('imdecode', timings.get('imdecode', 0) * 1000)
+    metrics.record('detect', (timings.get('regions', 0) + timings.get('crops', 0) + timings.get('full', 0)) * 1000)
+    return result
+
+
+# Returns (the failed event and the ones after it, exception), or None when every event was handled
+def handle_events(group, states, images, followups):
+    for i, event_data in enumerate(group):
+        try:
+            message_body = handle_event(event_data, states, images, followups)
+            if message_body is not None:
+                reply_message(event_data['replyToken'], message_body)
+        except Exception as e:
+            return group[i:], e
+    return None
+
+
+def handle_event(event_data, states, images, followups):
+    message_body = None
+    
+    if event_data['type'] == 'follow':
+        user_state.get_state(states, event_data).reset()
+        return None
+    elif event_data['type'] == 'message':
+        state = user_state.get_state(states, event_data)
+        favorites = state.favorites
+        
+        if len(favorites) != 0:
+            message_body = [messages.menu_with_favorites]
+        else:
+            message_body = [messages.menu]
+        
+        if event_data['message']['type'] == 'location':
+            message_lat = event_data['message']['latitude']
+            message_lng = event_data['message']['longitude']
+            # スナップショットがあれば手元で検索する
+            directory = library_directory.get_directory()
+            if directory is not None:
+                libraries = directory.nearest(message_lat, message_lng, max_library)
+            else:
+                libraries = calil.nearby_libraries(message_lat, message_lng, max_library)
+            reply_text = ''
+            reply_column = []
+            reply_item = [messages.item_quit]
             
-            if len(favorites) != 0:
-                reply_item.append({
-                    'type': 'action',
-                    'action': {
-                        'type': 'message',
-                        'label': '蔵書を探す',
-                        'text': '蔵書を探す'
-                    }
-                })
-                reply_item.append({
-                    'type': 'action',
-                    'action': {
-                        'type': 'message',
-                        'label': '編集する',
-                        'text': '編集する'
-                    }
-                })
+            for i, library in enumerate(libraries):
+                logger.debug(library)
+                reply_text += str(i+1) + '. ' + library['short'] + '\n'
+                reply_column.append(messages.library_column(str(i+1) + '. ' + library['short'], library))
+                reply_item.append(messages.postback_item(str(i+1), 'action=add&number=' + str(i+1)))
             
-            message_body = [{
-                'type': 'text',
-                'text': 'ご用件は何ですか？',
-                'quickReply': {
-                    'items': reply_item
-                }
-            }]
+            if reply_text == '':
+                message_body = [messages.no_library_nearby]
+            else:
+                state.set_libraries(libraries)
+                
+                message_body = [messages.found_libraries]
+                message_body.append(messages.carousel(reply_text, reply_column, reply_item))
+        elif event_data['message']['type'] == 'image':
+            content_type = event_data['message']['contentProvider']['type']
             
-            if event_data['message']['type'] == 'location':
-                message_lat = event_data['message']['latitude']
-                message_lng = event_data['message']['longitude']
-                url = 'https://api.calil.jp/library'
-                appkey = os.getenv('CALIL_APPKEY', None)
-                req = urllib.request.Request(url + '?appkey=' + appkey + '&geocode=' + str(message_lng) + ',' + str(message_lat) + '&format=json&callback=&limit=' + str(max_library))
-                with urllib.request.urlopen(req) as res:
-                    res_body = res.read()
-                    logger.info(res_body)
+            if content_type == 'line':
+                result = images[event_data['message']['id']].result()
+                if isinstance(result, line_api.ContentError):
+                    logger.info(str(result))
+                    return [messages.image_unreadable]
+                if isinstance(result, Exception):
+                    logger.error('Image processing failed: ' + event_data['message']['id'], exc_info=result)
+                    return [messages.image_unreadable]
+                
+                found, codes, timings = result
+                # 書籍のバーコード(978/979)だけを残す
+                codes = isbn.book_codes(codes)
+                if found == True:
+                    logger.debug(codes)
                     
                     reply_text = ''
-                    reply_column = []
-                    reply_item = [{
-                        'type': 'action',
-                        'action': {
-                            'type': 'message',
-                            'label': 'やめる',
-                            'text': 'やめる'
-                        }
-                    }]
+                    reply_item = [messages.item_quit]
                     
-                    for i, library in enumerate(json.loads(res_body)):
-                        logger.info(library)
-                        reply_text += str(i+1) + '. ' + library['short'] + '\n'
-                        reply_column.append({
-                            'title': str(i+1) + '. ' + library['short'],
-                            'text': library['formal'] + '\n' + library['address'],
-                            'defaultAction': {
-                                'type': 'uri',
-                                'label': '詳細を見る',
-                                'uri': 'https://calil.jp/library/' + library['libid'] + '/' + urllib.parse.quote(library['formal'])
-                            },
-                            'actions': [{
-                                'type': 'uri',
-                                'label': '詳細を見る',
-                                'uri': 'https://calil.jp/library/' + library['libid'] + '/' + urllib.parse.quote(library['formal'])
-                            }]
-                        })
-                        reply_item.append({
-                            'type': 'action',
-                            'action': {
-                                'type': 'postback',
-                                'label': str(i+1),
-                                'data': 'action=add&number=' + str(i+1),
-                                'displayText': str(i+1)
-                            }
-                        })
+                    for i, code in enumerate(codes):
+                        logger.debug(code)
+                        if code != '':
+                            reply_text += str(i+1) + '. ' + code + '\n'
+                            reply_item.append(messages.message_item(str(i+1), code))
+                    
+                    # 複数の書籍はまとめて調べられる
+                    if len(codes) >= 2:
+                        reply_item.append(messages.message_item('まとめて調べる', ','.join(codes[:max_bulk])))
                     
                     if reply_text == '':
-                        message_body = [{
-                            'type': 'text',
-                            'text': '近くに図書館は無さそうです。'
-                        }]
+                        message_body = [messages.barcode_unreadable]
                     else:
-                        table.update_item(
-                            Key = {'userId': event_data['source']['userId']},
-                            UpdateExpression = "set libraries=:l",
-                            ExpressionAttributeValues = {
-                                ':l': json.loads(res_body, parse_float=decimal.Decimal)
-                            },
-                            ReturnValues="UPDATED_NEW"
-                        )
-                        
-                        message_body = [{
-                            'type': 'text',
-                            'text': '近くの図書館をお調べしました。\nお気に入り図書館に登録すると蔵書を検索できます。登録したい図書館の番号を教えて下さい。'
-                        }]
-                        message_body.append({
-                            'type': 'template',
-                            'altText': reply_text,
-                            'template': {
-                                'type': 'carousel',
-                                'columns': reply_column
-                            },
-                            'quickReply': {
-                                'items': reply_item
-                            }
-                        })
-            elif event_data['message']['type'] == 'image':
-                content_type = event_data['message']['contentProvider']['type']
+                        message_body = [messages.text('バーコードを読み取りました。\n' + reply_text + '\n調べたい書籍のISBNを教えて下さい。', reply_item)]
+                else:
+                    message_body = [messages.barcode_not_found]
+            else:
+                return None
+        elif event_data['message']['type'] == 'text':
+            message_text = event_data['message']['text']
+            isbn_list = isbn.parse_list(message_text)
+            
+            if message_text == 'やめる':
+                state.set_libraries([])
                 
-                if content_type == 'line':
-                    url = 'https://api-data.line.me/v2/bot/message/'
-                    headers = {
-                        'Authorization': 'Bearer ' + channel_access_token,
-                    }
-                    req = urllib.request.Request(url + str(event_data['message']['id']) + '/content', headers=headers)
-                    with urllib.request.urlopen(req) as res:
-                        res_body = res.read()
-                        
-                        arr = np.frombuffer(res_body, dtype=np.uint8)
-                        img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-                        retval, decoded_info, decoded_type, points = bd.detectAndDecode(img)
-                        if retval == True:
-                            logger.info(decoded_info)
-                            
-                            reply_text = ''
-                            reply_item = [{
-                                'type': 'action',
-                                'action': {
-                                    'type': 'message',
-                                    'label': 'やめる',
-                                    'text': 'やめる'
-                                }
-                            }]
-                            
-                            for i, code in enumerate(decoded_info):
-                                logger.info(code)
-                                if code != '':
-                                    reply_text += str(i+1) + '. ' + code + '\n'
-                                    reply_item.append({
-                                        'type': 'action',
-                                        'action': {
-                                            'type': 'message',
-                                            'label': str(i+1),
-                                            'text': code
-                                        }
-                                    })
-                            
-                            if reply_text == '':
-                                message_body = [{
-                                    'type': 'text',
-                                    'text': 'バーコードを読み取れません。'
-                                }]
-                            else:
-                                message_body = [{
-                                    'type': 'text',
-                                    'text': 'バーコードを読み取りました。\n' + reply_text + '\n調べたい書籍のISBNを教えて下さい。',
-                                    'quickReply': {
-                                        'items': reply_item
-                                    }
-                                }]
-                        else:
-                            message_body = [{
-                                'type': 'text',
-                                'text': 'バーコードが見つかりません。'
-                            }]
+                message_body = [messages.bye]
+            elif message_text == '図書館を探す':
+                message_body = [messages.ask_location]
+            elif message_text == '蔵書を探す':
+                if len(favorites) == 0:
+                    message_body = [messages.need_favorites]
                 else:
-                    continue
-            elif event_data['message']['type'] == 'text':
-                message_text = event_data['message']['text']
-                valid_isbn = r'^(\d{10}|\d{13})$'
+                    reply_text = ''
+                    for i, library in enumerate(favorites):
+                        logger.debug(library)
+                        reply_text += str(i+1) + '. ' + library['short'] + '\n'
+                    
+                    message_body = [messages.text(
+                        '以下のお気に入り図書館の蔵書をお調べします。\n' + reply_text + '\n調べたい書籍のISBN(バーコードの画像、もしくは10桁または13桁の数字)を教えて下さい。\n例：9784834000825',
+                        [messages.item_quit, messages.item_camera, messages.item_camera_roll]
+                    )]
+            # ISBN(10桁または13桁の数字)
+            elif isbn.looks_like(message_text):
+                # 検索の対象はISBN-13にそろえる
+                isbn13 = isbn.canonical(message_text)
                 
-                if message_text == 'やめる':
-                    remove_all_libraries(event_data)
+                if isbn13 is None:
+                    message_body = [messages.invalid_isbn]
+                elif len(favorites) == 0:
+                    message_body = [messages.need_favorites]
+                else:
+                    systemids = ''
+                    for i, library in enumerate(favorites):
+                        logger.debug(library)
+                        if i == 0:
+                            systemids += library['systemid']
+                        else:
+                            systemids += ',' + library['systemid']
+                    logger.debug(systemids)
                     
-                    message_body = [{
-                        'type': 'text',
-                        'text': 'またね。'
-                    }]
-                elif message_text == '図書館を探す':
-                    message_body = [{
-                        'type': 'text',
-                        'text': '近くの図書館をお調べします。\n位置情報を教えて下さい。',
-                        'quickReply': {
-                            'items': [{
-                                'type': 'action',
-                                'action': {
-                                    'type': 'message',
-                                    'label': 'やめる',
-                                    'text': 'やめる'
-                                }
-                            },
-                            {
-                                'type': 'action',
-                                'action': {
-                                    'type': 'location',
-                                    'label': '位置情報を送る',
-                                }
-                            }]
-                        }
-                    }]
-                elif message_text == '蔵書を探す':
-                    response = table.get_item(Key = {'userId': event_data['source']['userId']})
-                    favorites = response["Item"]['favorites']
+                    # 段階的に届ける場合は、最初の応答までに分かった結果だけで返信する
+                    res = calil.check(isbn13, systemids, first_result_wait if progressive_delivery else None)
+                    message_body = holdings_message(isbn13, favorites, res, messages.found_holdings, messages.no_holdings)
                     
-                    if len(favorites) == 0:
-                        message_body = [{
-                            'type': 'text',
-                            'text': '蔵書を探すにはお気に入り図書館を登録する必要があります。\n近くの図書館を探しますか？',
-                            'quickReply': {
-                                'items': [{
-                                    'type': 'action',
-                                    'action': {
-                                        'type': 'message',
-                                        'label': 'やめる',
-                                        'text': 'やめる'
-                                    }
-                                },
-                                {
-                                    'type': 'action',
-                                    'action': {
-                                        'type': 'message',
-                                        'label': '図書館を探す',
-                                        'text': '図書館を探す'
-                                    }
-                                }]
-                            }
-                        }]
-                    else:
-                        reply_text = ''
-                        for i, library in enumerate(favorites):
-                            logger.info(library)
-                            reply_text += str(i+1) + '. ' + library['short'] + '\n'
-                        
-                        message_body = [{
-                            'type': 'text',
-                            'text': '以下のお気に入り図書館の蔵書をお調べします。\n' + reply_text + '\n調べたい書籍のISBN(バーコードの画像、もしくは10桁または13桁の数字)を教えて下さい。\n例：9784834000825',
-                            'quickReply': {
-                                'items': [{
-                                    'type': 'action',
-                                    'action': {
-                                        'type': 'message',
-                                        'label': 'やめる',
-                                        'text': 'やめる'
-                                    }
-                                },
-                                {
-                                    'type': 'action',
-                                    'action': {
-                                        'type': 'camera',
-                                        'label': 'カメラを起動する'
-                                    }
-                                },
-                                {
-                                    'type': 'action',
-                                    'action': {
-                                        'type': 'cameraRoll',
-                                        'label': 'カメラロールを開く'
-                                    }
-                                }]
-                            }
-                        }]
-                # ISBN(10桁または13桁の数字)
-                elif re.match(valid_isbn, message_text) is not None:
-                    response = table.get_item(Key = {'userId': event_data['source']['userId']})
-                    favorites = response["Item"]['favorites']
+                    running = [library for library in favorites if res.is_running(isbn13, library['systemid'])]
+                    if progressive_delivery and len(running) != 0:
+                        message_body.append(messages.checking_rest)
+                        followups.setdefault(event_data['source']['userId'], []).append((isbn13, running, res.session))
+            # 複数のISBN(カンマ、空白または改行区切り)
+            elif isbn_list is not None:
+                if len(favorites) == 0:
+                    message_body = [messages.need_favorites]
+                else:
+                    message_body = bulk_message(isbn_list, favorites)
+            elif message_text == '編集する':
+                if len(favorites) == 0:
+                    message_body = [messages.no_favorites]
+                else:
+                    reply_text = ''
+                    reply_column = []
+                    reply_item = [messages.item_quit, messages.item_delete_all]
                     
-                    if len(favorites) == 0:
-                        message_body = [{
-                            'type': 'text',
-                            'text': '蔵書を探すにはお気に入り図書館を登録する必要があります。\n近くの図書館を探しますか？',
-                            'quickReply': {
-                                'items': [{
-                                    'type': 'action',
-                                    'action': {
-                                        'type': 'message',
-                                        'label': 'やめる',
-                                        'text': 'やめる'
-                                    }
-                                },
-                                {
-                                    'type': 'action',
-                                    'action': {
-                                        'type': 'message',
-                                        'label': '図書館を探す',
-                                        'text': '図書館を探す'
-                                    }
-                                }]
-                            }
-                        }]
-                    else:
-                        url = 'https://api.calil.jp/check'
-                        appkey = os.getenv('CALIL_APPKEY', None)
-                        
-                        systemids = ''
-                        for i, library in enumerate(favorites):
-                            logger.info(library)
-                            if i == 0:
-                                systemids += library['systemid']
-                            else:
-                                systemids += ',' + library['systemid']
-                        logger.info(systemids)
-                        
-                        req = urllib.request.Request(url + '?appkey=' + appkey + '&isbn=' + message_text + '&systemid=' + systemids + '&format=json&callback=no')
-                        with urllib.request.urlopen(req) as res:
-                            res_body = res.read()
-                            logger.info(res_body)
-                            
-                            while json.loads(res_body).get('continue', '') != 0:
-                                time.sleep(2)
-                                req = urllib.request.Request(url + '?appkey=' + appkey +'&session=' + json.loads(res_body).get('session', '') + '&format=json&callback=no')
-                                with urllib.request.urlopen(req) as res:
-                                    res_body = res.read()
-                                    logger.info(res_body)
-                            
-                            reply_text = ''
-                            reply_column = []
-                            for i, library in enumerate(favorites):
-                                logger.info(library)
-                                for libkey in json.loads(res_body).get('books').get(message_text).get(library['systemid']).get('libkey', ''):
-                                    logger.info(libkey)
-                                    if libkey == library['libkey']:
-                                        reply_text += library['short'] + '：' + json.loads(res_body).get('books').get(message_text).get(library['systemid']).get('libkey', '').get(libkey, '') + '\n'
-                                        reply_column.append({
-                                            'title': '【' + json.loads(res_body).get('books').get(message_text).get(library['systemid']).get('libkey', '').get(libkey, '') + '】' + library['short'],
-                                            'text': library['formal'] + '\n' + library['address'],
-                                            'defaultAction': {
-                                                'type': 'uri',
-                                                'label': '詳細を見る',
-                                                'uri': 'https://calil.jp/library/' + library['libid'] + '/' + urllib.parse.quote(library['formal'])
-                                            },
-                                            'actions': [{
-                                                'type': 'uri',
-                                                'label': '詳細を見る',
-                                                'uri': 'https://calil.jp/library/' + library['libid'] + '/' + urllib.parse.quote(library['formal'])
-                                            }]
-                                        })
-                                        break
-                            
-                            reply_column.append({
-                                'title': '検索した書籍',
-                                'text': 'ISBN '+ message_text,
-                                'defaultAction': {
-                                    'type': 'uri',
-                                    'label': '詳細を見る',
-                                    'uri': 'https://calil.jp/book/' + message_text
-                                },
-                                'actions': [{
-                                    'type': 'uri',
-                                    'label': '詳細を見る',
-                                    'uri': 'https://calil.jp/book/' + message_text
-                                }]
-                            })
-                            
-                            if reply_text == '':
-                                message_body = [{
-                                    'type': 'text',
-                                    'text': 'お気に入り図書館に蔵書は無さそうです。'
-                                }]
-                            else:
-                                message_body = [{
-                                    'type': 'text',
-                                    'text': 'お気に入り図書館の蔵書の有無と貸出状況をお調べしました。'
-                                }]
-                                message_body.append({
-                                    'type': 'template',
-                                    'altText': reply_text,
-                                    'template': {
-                                        'type': 'carousel',
-                                        'columns': reply_column
-                                    }
-                                })
-                elif message_text == '編集する':
-                    response = table.get_item(Key = {'userId': event_data['source']['userId']})
-                    favorites = response["Item"]['favorites']
+                    for i, library in enumerate(favorites):
+                        logger.debug(library)
+                        reply_text += str(i+1) + '. ' + library['short'] + '\n'
+                        reply_column.append(messages.library_column(str(i+1) + '. ' + library['short'], library))
+                        reply_item.append(messages.postback_item(str(i+1), 'action=remove&number=' + str(i+1)))
                     
-                    if len(favorites) == 0:
-                        message_body = [{
-                            'type': 'text',
-                            'text': 'お気に入り図書館はありません。'
-                        }]
-                    else:
-                        reply_text = ''
-                        reply_column = []
-                        reply_item = [{
-                            'type': 'action',
-                            'action': {
-                                'type': 'message',
-                                'label': 'やめる',
-                                'text': 'やめる'
-                            }
-                        },
-                        {
-                            'type': 'action',
-                            'action': {
-                                'type': 'message',
-                                'label': '全削除',
-                                'text': '全削除'
-                            }
-                        }]
-                        
-                        for i, library in enumerate(favorites):
-                            logger.info(library)
-                            reply_text += str(i+1) + '. ' + library['short'] + '\n'
-                            reply_column.append({
-                                'title': str(i+1) + '. ' + library['short'],
-                                'text': library['formal'] + '\n' + library['address'],
-                                'defaultAction': {
-                                    'type': 'uri',
-                                    'label': '詳細を見る',
-                                    'uri': 'https://calil.jp/library/' + library['libid'] + '/' + urllib.parse.quote(library['formal'])
-                                },
-                                'actions': [{
-                                    'type': 'uri',
-                                    'label': '詳細を見る',
-                                    'uri': 'https://calil.jp/library/' + library['libid'] + '/' + urllib.parse.quote(library['formal'])
-                                }]
-                            })
-                            reply_item.append({
-                                'type': 'action',
-                                'action': {
-                                    'type': 'postback',
-                                    'label': str(i+1),
-                                    'data': 'action=remove&number=' + str(i+1),
-                                    'displayText': str(i+1)
-                                }
-                            })
-                        
-                        message_body = [{
-                            'type': 'text',
-                            'text': 'お気に入り図書館を編集します。\n削除したい図書館の番号を教えて下さい。'
-                        }]
-                        message_body.append({
-                            'type': 'template',
-                            'altText': reply_text,
-                            'template': {
-                                'type': 'carousel',
-                                'columns': reply_column
-                            },
-                            'quickReply': {
-                                'items': reply_item
-                            }
-                        })
-                elif message_text == '全削除':
-                    remove_all_favorites(event_data)
+                    message_body = [messages.edit_favorites]
+                    message_body.append(messages.carousel(reply_text, reply_column, reply_item))
+            elif message_text == '全削除':
+                state.clear_favorites()
+                
+                message_body = [messages.favorites_deleted]
+        else:
+            return None
+    elif event_data['type'] == 'postback':
+        postback_data = dict(urllib.parse.parse_qsl(event_data['postback']['data']))
+        action = postback_data.get('action', '')
+        number = postback_data.get('number', '0')
+        
+        state = user_state.get_state(states, event_data)
+        libraries = state.libraries
+        favorites = state.favorites
+        
+        if action == 'add':
+            if len(libraries) != 0 and int(number) <= len(libraries):
+                if len(favorites) < max_library:
+                    reply_text = ''
+                    for i, library in enumerate(favorites):
+                        logger.debug(library)
+                        if library['libid'] == libraries[int(number)-1]['libid']:
+                            reply_text = library['short']
+                            break
                     
-                    message_body = [{
-                        'type': 'text',
-                        'text': 'お気に入り図書館を削除しました。'
-                    }]
-            else:
-                continue
-        elif event_data['type'] == 'postback':
-            postback_data = event_data['postback']['data']
-            data_list = postback_data.split('&')
-            action = data_list[0].split('=')[1]
-            number = data_list[1].split('=')[1]
-            
-            response = table.get_item(Key = {'userId': event_data['source']['userId']})
-            libraries = response["Item"]['libraries']
-            favorites = response["Item"]['favorites']
-            
-            if action == 'add':
-                if len(libraries) != 0 and int(number) <= len(libraries):
-                    if len(favorites) < max_library:
-                        reply_text = ''
-                        for i, library in enumerate(favorites):
-                            logger.info(library)
-                            if library['libid'] == libraries[int(number)-1]['libid']:
-                                reply_text = library['short']
-                                break
+                    if reply_text == '':
+                        reply_text = libraries[int(number)-1]['short']
                         
-                        if reply_text == '':
-                            favorites.append(libraries[int(number)-1])
-                            
-                            table.update_item(
-                                Key = {'userId': event_data['source']['userId']},
-                                UpdateExpression = "set libraries=:l, favorites=:f",
-                                ExpressionAttributeValues = {
-                                    ':l': [],
-                                    ':f': favorites
-                                },
-                                ReturnValues="UPDATED_NEW"
-                            )
+                        state.add_favorite(libraries[int(number)-1], max_library)
+                        state.set_libraries([])
                         
-                            reply_text = libraries[int(number)-1]['short']
-                            message_body = [{
-                                'type': 'text',
-                                'text': number + '. ' + reply_text + '\nをお気に入りに登録しました。'
-                            }]
-                        else:
-                            remove_all_libraries(event_data)
-                            
-                            message_body = [{
-                                'type': 'text',
-                                'text': number + '. ' + reply_text + '\nは登録済みです。'
-                            }]
+                        message_body = [messages.text(number + '. ' + reply_text + '\nをお気に入りに登録しました。')]
                     else:
-                        remove_all_libraries(event_data)
-                            
-                        message_body = [{
-                            'type': 'text',
-                            'text': 'お気に入り図書館がいっぱいのため、登録できません。\nお気に入り図書館を編集しますか？',
-                            'quickReply': {
-                                'items': [{
-                                    'type': 'action',
-                                    'action': {
-                                        'type': 'message',
-                                        'label': 'やめる',
-                                        'text': 'やめる'
-                                    }
-                                },
-                                {
-                                    'type': 'action',
-                                    'action': {
-                                        'type': 'message',
-                                        'label': '編集する',
-                                        'text': '編集する'
-                                    }
-                                }]
-                            }
-                        }]
-            elif action == 'remove':
-                if len(favorites) != 0 and int(number) <= len(favorites):
-                    reply_text = favorites[int(number)-1]['short']
-                    
-                    favorites.pop(int(number)-1)
-                    
-                    table.update_item(
-                        Key = {'userId': event_data['source']['userId']},
-                        UpdateExpression = "set favorites=:f",
-                        ExpressionAttributeValues = {
-                            ':f': favorites
-                        },
-                        ReturnValues="UPDATED_NEW"
-                    )
+                        state.set_libraries([])
+                        
+                        message_body = [messages.text(number + '. ' + reply_text + '\nは登録済みです。')]
+                else:
+                    state.set_libraries([])
                     
-                    message_body = [{
-                        'type': 'text',
-                        'text': number + '. ' + reply_text + '\nをお気に入りから削除しました。'
-                    }]
-            else:
-                continue
+                    message_body = [messages.favorites_full]
+        elif action == 'remove':
+            if len(favorites) != 0 and int(number) <= len(favorites):
+                reply_text = favorites[int(number)-1]['short']
+                
+                state.remove_favorite(favorites[int(number)-1]['libid'])
+                
+                message_body = [messages.text(number + '. ' + reply_text + '\nをお気に入りから削除しました。')]
+        elif action == 'watch':
+            if len(favorites) != 0 and watchlist.enabled() and isbn.canonical(postback_data.get('isbn', '')) is not None:
+                watchlist.subscribe(event_data['source']['userId'], isbn.canonical(postback_data['isbn']), favorites)
+                
+                message_body = [messages.watching]
         else:
+            return None
+    elif event_data['type'] == 'followup':
+        # 返信の後にキューに積まれた確認中の図書館。結果は最後にまとめてプッシュする
+        items = followups.setdefault(event_data['source']['userId'], [])
+        for item in event_data['followups']:
+            items.append((item['isbn'], item['libraries'], item.get('session')))
+        return None
+    else:
+        return None
+    
+    return message_body
+
+
+def reply_message(reply_token, message_body):
+    url = line_api.reply_url
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + channel_access_token,
+    }
+    body = messages.reply_body(reply_token, message_body)
+    logger.debug(body)
+    # A reply token can be used only once, so a reply that may have been delivered is not sent again
+    with metrics.timer('line_reply'):
+        res = http_client.post(url, body, headers=headers, retries=0)
+    res_body = res.body.decode('utf-8')
+    if res_body != '{}':
+        logger.info(res_body)
+
+
+def holdings_message(isbn13, libraries, res, found, not_found):
+    reply_text = ''
+    reply_column = []
+    waiting = False
+    for library in libraries:
+        logger.debug(library)
+        # 期限内に検索が終わらなかった図書館
+        if res.is_running(isbn13, library['systemid']):
+            reply_text += library['short'] + '：確認中\n'
+            reply_column.append(messages.library_column('【確認中】' + library['short'], library))
             continue
-        
-        url = 'https://api.line.me/v2/bot/message/reply'
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + channel_access_token,
-        }
-        body = {
-            'replyToken': event_data['replyToken'],
-            'messages': message_body
-        }
-        logger.info(message_body)
-        req = urllib.request.Request(url, data=json.dumps(body).encode('utf-8'), method='POST', headers=headers)
-        with urllib.request.urlopen(req) as res:
-            res_body = res.read().decode('utf-8')
-            if res_body != '{}':
-                logger.info(res_body)
+        status = res.status(isbn13, library['systemid'], library['libkey'])
+        if status is not None:
+            if status not in watchlist.available_status:
+                waiting = True
+            reply_text += library['short'] + '：' + status + '\n'
+            reply_column.append(messages.library_column('【' + status + '】' + library['short'], library))
     
-    return {'statusCode': 200, 'body': '{}'}
+    reply_column.append(messages.book_column('検索した書籍', 'ISBN ' + isbn13, isbn13))
+    
+    if reply_text == '':
+        return [not_found]
+    # 貸出中などの図書館があれば、借りられるようになったときに通知できる
+    if waiting and watchlist.enabled():
+        return [found, messages.carousel(reply_text, reply_column, [messages.item_quit, messages.postback_item('借りられたら通知する', 'action=watch&isbn=' + isbn13)])]
+    return [found, messages.carousel(reply_text, reply_column)]
+
+
+# ユーザーごとの 'followup' イベントにしてキューに積む。積めなければその場でプッシュする
+def defer(followups):
+    events = []
+    for user_id, items in followups.items():
+        events.append({
+            'type': 'followup',
+            'source': {'type': 'user', 'userId': user_id},
+            # 古い行の図書館には数値(Decimal)の項目もあるので、使う項目だけを積む
+            'followups': [{'isbn': isbn13, 'libraries': [library_records.trim(library) for library in libraries], 'session': session} for isbn13, libraries, session in items]
+        })
+    try:
+        event_queue.get_queue().enqueue(events)
+    except Exception:
+        logger.exception('Follow-up enqueue failed')
+        push_followups(followups)
+
 
+# 最初の検索のセッションを続けて確認中だった図書館を待ち、ユーザーごとに1回のプッシュで送る
+def push_followups(followups):
+    queries = []
+    owners = []
+    for user_id, items in followups.items():
+        for isbn13, libraries, session in items:
+            queries.append((isbn13, ','.join(dict.fromkeys(library['systemid'] for library in libraries)), session))
+            owners.append((user_id, isbn13, libraries))
+    
+    # 返信は済んでいるので、失敗してもイベントの再送にはしない
+    try:
+        results = calil.resume_many(queries, return_exceptions=True)
+    except Exception:
+        logger.exception('Follow-up check failed')
+        return
+
+    bodies = {}
+    for (user_id, isbn13, libraries), res in zip(owners, results):
+        if isinstance(res, Exception):
+            logger.error('Follow-up check failed: ' + isbn13 + ': ' + str(res))
+            continue
+        bodies.setdefault(user_id, []).extend(holdings_message(isbn13, libraries, res, messages.rest_holdings, messages.rest_no_holdings))
+    
+    for user_id, message_body in bodies.items():
+        try:
+            with metrics.timer('line_push'):
+                line_api.push(user_id, message_body)
+        except Exception:
+            logger.exception('Push failed: ' + user_id)
 
-def remove_all_libraries(event_data):
-    table.update_item(
-        Key = {'userId': event_data['source']['userId']},
-        UpdateExpression = "set libraries=:l",
-        ExpressionAttributeValues = {
-            ':l': []
-        },
-        ReturnValues="UPDATED_NEW"
-    )
-
-
-def remove_all_favorites(event_data):
-    table.update_item(
-        Key = {'userId': event_data['source']['userId']},
-        UpdateExpression = "set favorites=:f",
-        ExpressionAttributeValues = {
-            ':f': []
-        },
-        ReturnValues="UPDATED_NEW"
-    )
+
+def bulk_message(isbn_list, favorites):
+    isbn13s = []
+    invalid = []
+    for item in isbn_list:
+        isbn13 = isbn.canonical(item)
+        if isbn13 is None:
+            invalid.append(item)
+        elif isbn13 not in isbn13s:
+            isbn13s.append(isbn13)
+    
+    if len(isbn13s) == 0:
+        return [messages.invalid_isbn]
+    
+    systemids = ','.join(dict.fromkeys(library['systemid'] for library in favorites))
+    # 1回のセッションで全ての書籍を調べる
+    res = calil.check_bulk(isbn13s[:max_bulk], systemids)
+    
+    reply_text = ''
+    reply_column = []
+    for isbn13 in isbn13s[:max_bulk]:
+        lines = []
+        for library in favorites:
+            status = res.status(isbn13, library['systemid'], library['libkey'])
+            if res.is_running(isbn13, library['systemid']):
+                lines.append(library['short'] + '：確認中')
+            elif status is not None:
+                lines.append(library['short'] + '：' + status)
+        
+        reply_text += 'ISBN ' + isbn13 + '\n' + ''.join(line + '\n' for line in lines)
+        reply_column.append(messages.book_column('ISBN ' + isbn13, ('\n'.join(lines) if len(lines) != 0 else '蔵書は無さそうです。')[:60], isbn13))
+    
+    text = 'お気に入り図書館の蔵書の有無と貸出状況をまとめてお調べしました。'
+    if len(invalid) != 0:
+        text += '\n正しくないISBNは除きました：' + '、'.join(invalid)
+    if len(isbn13s) > max_bulk:
+        text += '\n' + str(max_bulk) + '冊までお調べしました。'
+    
+    return [messages.text(text), messages.carousel(reply_text[:400], reply_column)]
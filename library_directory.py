@@ -0,0 +1,226 @@
+import os
+import sys
+import logging
+import json
+
+import urllib.parse
+
+import math
+import time
+
+import aws
+import calil_model
+import http_client
+import rate_limit
+
+logger = logging.getLogger()
+
+library_url = os.getenv('CALIL_BASE_URL', 'https://api.calil.jp') + '/library'
+
+prefectures = [
+    '北海道', '青森県', '岩手県', '宮城県', '秋田県', '山形県', '福島県',
+    '茨城県', '栃木県', '群馬県', '埼玉県', '千葉県', '東京都', '神奈川県',
+    '新潟県', '富山県', '石川県', '福井県', '山梨県', '長野県', '岐阜県',
+    '静岡県', '愛知県', '三重県', '滋賀県', '京都府', '大阪府', '兵庫県',
+    '奈良県', '和歌山県', '鳥取県', '島根県', '岡山県', '広島県', '山口県',
+    '徳島県', '香川県', '愛媛県', '高知県', '福岡県', '佐賀県', '長崎県',
+    '熊本県', '大分県', '宮崎県', '鹿児島県', '沖縄県'
+]
+
+# Fields of a Calil /library entry kept in the snapshot, in the order they are stored
+fields = calil_model.library_fields
+
+snapshot_path = os.getenv('LIBRARY_SNAPSHOT', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libraries.npz'))
+snapshot_bucket = os.getenv('SnapshotBucket', None)
+snapshot_key = os.getenv('SnapshotKey', 'libraries.npz')
+snapshot_reload = float(os.getenv('LIBRARY_SNAPSHOT_RELOAD', '86400'))
+
+# Grid cell size in degrees (about 11km north-south)
+cell_size = 0.1
+
+
+def fetch_prefecture(pref):
+    appkey = os.getenv('CALIL_APPKEY', None)
+    query = urllib.parse.urlencode({
+        'appkey': appkey,
+        'pref': pref,
+        'format': 'json',
+        'callback': ''
+    })
+    if not rate_limit.acquire('background'):
+        raise rate_limit.RateLimited(pref)
+    return http_client.get(library_url + '?' + query).json()
+
+
+def import_snapshot(path):
+    import numpy as np
+    records = []
+    lats = []
+    lngs = []
+    for pref in prefectures:
+        libraries = fetch_prefecture(pref)
+        logger.info(pref + ': ' + str(len(libraries)))
+        for library in libraries:
+            try:
+                lng, lat = library['geocode'].split(',')
+                lat = float(lat)
+                lng = float(lng)
+            except (KeyError, ValueError):
+                continue
+            records.append([library.get(field, '') for field in fields])
+            lats.append(lat)
+            lngs.append(lng)
+
+    # Library details are stored as one UTF-8 JSON blob next to the coordinate arrays
+    blob = json.dumps(records, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    with open(path, 'wb') as f:
+        np.savez_compressed(
+            f,
+            lat=np.array(lats, dtype=np.float64),
+            lng=np.array(lngs, dtype=np.float64),
+            records=np.frombuffer(blob, dtype=np.uint8)
+        )
+    return len(records)
+
+
+# Grid index of the snapshot. numpy is imported in the methods so that only location events load it.
+class LibraryDirectory:
+    def __init__(self, lat, lng, records):
+        import numpy as np
+        self.lat = lat
+        self.lng = lng
+        self.records = records
+
+        cell_lat = np.floor(lat / cell_size).astype(np.int64)
+        cell_lng = np.floor(lng / cell_size).astype(np.int64)
+        self.lat_min = int(cell_lat.min()) if len(lat) else 0
+        self.lng_min = int(cell_lng.min()) if len(lng) else 0
+        self.lat_cells = int(cell_lat.max()) - self.lat_min + 1 if len(lat) else 0
+        self.lng_cells = int(cell_lng.max()) - self.lng_min + 1 if len(lng) else 0
+
+        # Points sorted by cell so that each cell is a contiguous slice of self.order
+        cells = (cell_lat - self.lat_min) * self.lng_cells + (cell_lng - self.lng_min)
+        self.order = np.argsort(cells, kind='stable')
+        self.cells = cells[self.order]
+
+        # Lower bound of the distance covered by one ring of cells, at the highest latitude in the data
+        max_lat = float(np.abs(lat).max()) if len(lat) else 0.0
+        self.ring_km = cell_size * 111.32 * math.cos(math.radians(min(max_lat + cell_size, 89.0)))
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+        with np.load(path) as data:
+            records = json.loads(data['records'].tobytes().decode('utf-8'))
+            return cls(data['lat'], data['lng'], records)
+
+    def cell_points(self, row, col):
+        import numpy as np
+        if row < 0 or row >= self.lat_cells or col < 0 or col >= self.lng_cells:
+            return None
+        cell = row * self.lng_cells + col
+        start = np.searchsorted(self.cells, cell, side='left')
+        end = np.searchsorted(self.cells, cell, side='right')
+        if start == end:
+            return None
+        return self.order[start:end]
+
+    def distances(self, index, lat, lng):
+        import numpy as np
+        p1 = math.radians(lat)
+        p2 = np.radians(self.lat[index])
+        dl = np.radians(self.lng[index] - lng)
+        a = np.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * np.cos(p2) * np.sin(dl / 2) ** 2
+        return 6371.0 * 2 * np.arcsin(np.sqrt(a))
+
+    # Cells of the ring that lie inside the grid
+    def ring_cells(self, row, col, ring):
+        if ring == 0:
+            return [(row, col)]
+        cells = []
+        col_range = range(max(col - ring, 0), min(col + ring, self.lng_cells - 1) + 1)
+        for r in (row - ring, row + ring):
+            if 0 <= r < self.lat_cells:
+                cells += [(r, c) for c in col_range]
+        row_range = range(max(row - ring + 1, 0), min(row + ring - 1, self.lat_cells - 1) + 1)
+        for c in (col - ring, col + ring):
+            if 0 <= c < self.lng_cells:
+                cells += [(r, c) for r in row_range]
+        return cells
+
+    def nearest(self, lat, lng, k):
+        import numpy as np
+        if len(self.records) == 0 or k <= 0:
+            return []
+        row = int(math.floor(lat / cell_size)) - self.lat_min
+        col = int(math.floor(lng / cell_size)) - self.lng_min
+
+        # From outside the grid (e.g. abroad) the rings before the grid's edge are empty and skipped.
+        # The bound below stays ring * ring_km, measured from the user's own cell.
+        found = []
+        ring = max(0, -row, row - (self.lat_cells - 1), -col, col - (self.lng_cells - 1))
+        while True:
+            for r, c in self.ring_cells(row, col, ring):
+                points = self.cell_points(r, c)
+                if points is not None:
+                    found.append(points)
+            # The whole grid has been searched
+            if row - ring <= 0 and row + ring >= self.lat_cells - 1 and col - ring <= 0 and col + ring >= self.lng_cells - 1:
+                break
+            # Every point outside the searched rings is at least ring * ring_km away
+            if len(found) != 0:
+                index = np.concatenate(found)
+                if len(index) >= k:
+                    dist = self.distances(index, lat, lng)
+                    if np.partition(dist, k - 1)[k - 1] <= ring * self.ring_km:
+                        break
+            ring += 1
+
+        if len(found) == 0:
+            return []
+        index = np.concatenate(found)
+        dist = self.distances(index, lat, lng)
+        nearest = np.argsort(dist, kind='stable')[:k]
+        return [dict(zip(fields, self.records[int(index[i])])) for i in nearest]
+
+
+directory = None
+directory_loaded = 0
+
+
+def download_snapshot():
+    path = os.path.join('/tmp', os.path.basename(snapshot_key))
+    aws.client('s3').download_file(snapshot_bucket, snapshot_key, path)
+    return path
+
+
+# Loaded once per container and reloaded after LIBRARY_SNAPSHOT_RELOAD seconds. Returns None when no snapshot is available.
+def get_directory():
+    global directory, directory_loaded
+    if directory is not None and time.time() - directory_loaded < snapshot_reload:
+        return directory
+    try:
+        path = download_snapshot() if snapshot_bucket is not None else snapshot_path
+        if not os.path.exists(path):
+            return directory
+        directory = LibraryDirectory.load(path)
+        directory_loaded = time.time()
+        logger.info('Library snapshot loaded: ' + str(len(directory.records)))
+    except Exception:
+        logger.exception('Library snapshot load failed')
+    return directory
+
+
+# Scheduled (e.g. EventBridge) entry point that rebuilds the snapshot and uploads it to S3
+def refresh_handler(event, context):
+    path = os.path.join('/tmp', os.path.basename(snapshot_key))
+    count = import_snapshot(path)
+    if snapshot_bucket is not None:
+        aws.client('s3').upload_file(path, snapshot_bucket, snapshot_key)
+    logger.info('Library snapshot refreshed: ' + str(count))
+    return {'count': count}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print(import_snapshot(sys.argv[1] if len(sys.argv) > 1 else snapshot_path))
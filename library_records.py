@@ -0,0 +1,70 @@
+import os
+import logging
+
+import aws
+import cache
+import calil_model
+import metrics
+
+logger = logging.getLogger()
+
+# Library records shared by all users, keyed by libid, so that user rows only hold libids.
+# Without LibraryTableName user rows keep full records as before.
+table_name = os.getenv('LibraryTableName', None)
+
+# DynamoDB limit of BatchGetItem keys per request
+batch_get_size = 100
+
+records = cache.TTLCache(
+    ttl=float(os.getenv('LIBRARY_RECORD_TTL', '86400')),
+    maxsize=int(os.getenv('LIBRARY_RECORD_CACHE_SIZE', '8192'))
+)
+
+
+def enabled():
+    return table_name is not None
+
+
+def trim(library):
+    return {field: library.get(field, '') for field in calil_model.library_fields}
+
+
+# Stores the records of libraries shown to users. Records already known to this container are not written again.
+def register(libraries):
+    new = {}
+    for library in libraries:
+        library = trim(library)
+        value, state = records.lookup(library['libid'])
+        if value != library:
+            new[library['libid']] = library
+        records.set(library['libid'], library)
+    if table_name is None or len(new) == 0:
+        return
+    with metrics.timer('dynamodb_library_write'):
+        with aws.table(table_name).batch_writer(overwrite_by_pkeys=['libid']) as batch:
+            for library in new.values():
+                batch.put_item(Item = library)
+
+
+# {libid: record} of the libids found in the cache or the table
+def lookup(libids):
+    found = {}
+    missing = []
+    for libid in dict.fromkeys(libids):
+        value, state = records.lookup(libid)
+        if state is None:
+            missing.append(libid)
+        else:
+            found[libid] = value
+    if table_name is None or len(missing) == 0:
+        return found
+    with metrics.timer('dynamodb_library_load'):
+        for i in range(0, len(missing), batch_get_size):
+            request = {table_name: {'Keys': [{'libid': libid} for libid in missing[i:i+batch_get_size]]}}
+            while len(request) != 0:
+                response = aws.resource('dynamodb').batch_get_item(RequestItems = request)
+                for item in response['Responses'].get(table_name, []):
+                    records.set(item['libid'], item)
+                    found[item['libid']] = item
+                request = response.get('UnprocessedKeys', {})
+    return found
@@ -0,0 +1,109 @@
+import os
+import logging
+
+import uuid
+
+import http_client
+import messages
+
+logger = logging.getLogger()
+
+channel_access_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN', None)
+
+# Overridable so that the benchmark can run against a local stand-in
+api_base_url = os.getenv('LINE_API_BASE_URL', 'https://api.line.me')
+data_base_url = os.getenv('LINE_DATA_BASE_URL', 'https://api-data.line.me')
+
+content_url = data_base_url + '/v2/bot/message/'
+reply_url = api_base_url + '/v2/bot/message/reply'
+push_url = api_base_url + '/v2/bot/message/push'
+multicast_url = api_base_url + '/v2/bot/message/multicast'
+
+# Recipients per multicast request and messages per push or multicast request
+multicast_size = 500
+max_messages = 5
+
+content_max_bytes = int(os.getenv('LINE_CONTENT_MAX_BYTES', str(10 * 1024 * 1024)))
+# Initial buffer when the response has no Content-Length
+content_chunk = 256 * 1024
+
+image_signatures = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n')
+signature_bytes = max(len(signature) for signature in image_signatures)
+
+
+class ContentError(Exception):
+    pass
+
+
+# Streams the content of a message into one preallocated buffer and returns a memoryview of it.
+# Oversized or non-image content is rejected as soon as the headers or the first bytes show it.
+def fetch_image(message_id, max_bytes=None):
+    max_bytes = content_max_bytes if max_bytes is None else max_bytes
+    headers = {
+        'Authorization': 'Bearer ' + channel_access_token,
+    }
+    with http_client.get(content_url + str(message_id) + '/content', headers=headers, stream=True) as res:
+        content_type = res.headers.get('Content-Type', '')
+        if not content_type.startswith('image/'):
+            raise ContentError('Not an image: ' + content_type)
+        length = res.headers.get('Content-Length')
+        if length is not None:
+            length = int(length)
+            if length > max_bytes:
+                raise ContentError('Content too large: ' + str(length))
+
+        buffer = bytearray(length if length is not None else min(content_chunk, max_bytes))
+        view = memoryview(buffer)
+        size = 0
+        while True:
+            if size == len(buffer):
+                if length is not None:
+                    break
+                if len(buffer) >= max_bytes:
+                    raise ContentError('Content too large')
+                # Grow only when the size is unknown
+                buffer = bytearray(min(len(buffer) * 2, max_bytes))
+                buffer[:size] = view[:size]
+                view = memoryview(buffer)
+            n = res.readinto(view[size:])
+            if n == 0:
+                break
+            size += n
+            # Checked once the read that completes the signature bytes came in, reads can be shorter
+            if size - n < signature_bytes <= size and not bytes(view[:signature_bytes]).startswith(image_signatures):
+                raise ContentError('Unknown image format')
+        if size < signature_bytes:
+            raise ContentError('Unknown image format')
+        return view[:size]
+
+
+# The retry key stays the same across the retries of one request, so that LINE sends the messages
+# only once even when an earlier attempt was delivered. 409 means an earlier attempt was accepted.
+def post_messages(url, to, message_body):
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + channel_access_token,
+        'X-Line-Retry-Key': str(uuid.uuid4())
+    }
+    body = b'{"to":' + messages.encode(to) + b',"messages":[' + b','.join(message_body) + b']}'
+    try:
+        res = http_client.post(url, body, headers=headers)
+    except http_client.HTTPError as e:
+        if e.status != 409:
+            raise
+        logger.info('Already accepted: ' + e.body.decode('utf-8', 'replace'))
+        return
+    res_body = res.body.decode('utf-8')
+    if res_body != '{}':
+        logger.info(res_body)
+
+
+def push(user_id, message_body):
+    for i in range(0, len(message_body), max_messages):
+        post_messages(push_url, user_id, message_body[i:i+max_messages])
+
+
+# Sends the same messages to many users, multicast_size users per request
+def multicast(user_ids, message_body):
+    for i in range(0, len(user_ids), multicast_size):
+        post_messages(multicast_url, user_ids[i:i+multicast_size], message_body)
@@ -0,0 +1,139 @@
+import json
+import functools
+
+import urllib.parse
+
+# Messages are built from pre-encoded JSON fragments and joined as bytes,
+# the reply body is never serialized as a whole.
+
+
+def encode(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+@functools.lru_cache(maxsize=256)
+def message_item(label, text=None):
+    return encode({
+        'type': 'action',
+        'action': {
+            'type': 'message',
+            'label': label,
+            'text': label if text is None else text
+        }
+    })
+
+
+@functools.lru_cache(maxsize=256)
+def postback_item(label, data):
+    return encode({
+        'type': 'action',
+        'action': {
+            'type': 'postback',
+            'label': label,
+            'data': data,
+            'displayText': label
+        }
+    })
+
+
+item_quit = message_item('やめる')
+item_search_library = message_item('図書館を探す')
+item_search_book = message_item('蔵書を探す')
+item_edit = message_item('編集する')
+item_delete_all = message_item('全削除')
+item_location = encode({
+    'type': 'action',
+    'action': {
+        'type': 'location',
+        'label': '位置情報を送る',
+    }
+})
+item_camera = encode({
+    'type': 'action',
+    'action': {
+        'type': 'camera',
+        'label': 'カメラを起動する'
+    }
+})
+item_camera_roll = encode({
+    'type': 'action',
+    'action': {
+        'type': 'cameraRoll',
+        'label': 'カメラロールを開く'
+    }
+})
+
+
+def quick_reply(items):
+    return b',"quickReply":{"items":[' + b','.join(items) + b']}'
+
+
+def text(text, items=None):
+    message = b'{"type":"text","text":' + encode(text)
+    if items is not None:
+        message += quick_reply(items)
+    return message + b'}'
+
+
+def carousel(alt_text, columns, items=None):
+    message = b'{"type":"template","altText":' + encode(alt_text) + b',"template":{"type":"carousel","columns":[' + b','.join(columns) + b']}'
+    if items is not None:
+        message += quick_reply(items)
+    return message + b'}'
+
+
+def uri_actions(uri):
+    action = encode({
+        'type': 'uri',
+        'label': '詳細を見る',
+        'uri': uri
+    })
+    return b',"defaultAction":' + action + b',"actions":[' + action + b']'
+
+
+# Everything of a library column but the title, memoized per library
+@functools.lru_cache(maxsize=4096)
+def library_column_tail(libid, formal, address):
+    uri = 'https://calil.jp/library/' + libid + '/' + urllib.parse.quote(formal)
+    return b',"text":' + encode(formal + '\n' + address) + uri_actions(uri) + b'}'
+
+
+def library_column(title, library):
+    return b'{"title":' + encode(title) + library_column_tail(library['libid'], library['formal'], library['address'])
+
+
+@functools.lru_cache(maxsize=1024)
+def book_actions(isbn13):
+    return uri_actions('https://calil.jp/book/' + isbn13)
+
+
+def book_column(title, text, isbn13):
+    return b'{"title":' + encode(title) + b',"text":' + encode(text) + book_actions(isbn13) + b'}'
+
+
+def reply_body(reply_token, messages):
+    return b'{"replyToken":' + encode(reply_token) + b',"messages":[' + b','.join(messages) + b']}'
+
+
+# Fixed messages
+menu = text('ご用件は何ですか？', [item_quit, item_search_library])
+menu_with_favorites = text('ご用件は何ですか？', [item_quit, item_search_library, item_search_book, item_edit])
+bye = text('またね。')
+ask_location = text('近くの図書館をお調べします。\n位置情報を教えて下さい。', [item_quit, item_location])
+need_favorites = text('蔵書を探すにはお気に入り図書館を登録する必要があります。\n近くの図書館を探しますか？', [item_quit, item_search_library])
+no_library_nearby = text('近くに図書館は無さそうです。')
+found_libraries = text('近くの図書館をお調べしました。\nお気に入り図書館に登録すると蔵書を検索できます。登録したい図書館の番号を教えて下さい。')
+image_unreadable = text('画像を読み込めません。')
+barcode_unreadable = text('バーコードを読み取れません。')
+barcode_not_found = text('バーコードが見つかりません。')
+invalid_isbn = text('ISBNが正しくありません。\n番号をお確かめ下さい。')
+no_holdings = text('お気に入り図書館に蔵書は無さそうです。')
+found_holdings = text('お気に入り図書館の蔵書の有無と貸出状況をお調べしました。')
+no_favorites = text('お気に入り図書館はありません。')
+edit_favorites = text('お気に入り図書館を編集します。\n削除したい図書館の番号を教えて下さい。')
+favorites_deleted = text('お気に入り図書館を削除しました。')
+watching = text('借りられるようになったらお知らせします。')
+checking_rest = text('確認中の図書館は、結果が分かり次第お知らせします。')
+rest_holdings = text('確認中だった図書館の蔵書の有無と貸出状況をお調べしました。')
+rest_no_holdings = text('確認中だった図書館に蔵書は無さそうです。')
+favorites_full = text('お気に入り図書館がいっぱいのため、登録できません。\nお気に入り図書館を編集しますか？', [item_quit, item_edit])
@@ -0,0 +1,100 @@
+import os
+import sys
+import json
+
+import contextlib
+import contextvars
+import random
+import threading
+import time
+
+# Per-invocation stage timings, written as one CloudWatch Embedded Metric Format line.
+# Only a sample of invocations is traced; untraced invocations pay for a context lookup per stage.
+namespace = os.getenv('METRICS_NAMESPACE', 'LineBotCalil')
+sample_rate = float(os.getenv('METRICS_SAMPLE_RATE', '1'))
+
+current = contextvars.ContextVar('metrics_trace', default=None)
+
+
+class Trace:
+    def __init__(self, handler):
+        self.handler = handler
+        self.start = time.perf_counter()
+        self.values = {}  # metric -> [value, ...]
+        self.units = {}
+        self.lock = threading.Lock()
+
+    def add(self, metric, value, unit):
+        with self.lock:
+            self.values.setdefault(metric, []).append(round(value, 3))
+            self.units[metric] = unit
+
+    # EMF accepts up to 100 values per metric, each call of a stage is kept as its own value
+    def emit(self):
+        with self.lock:
+            values = {metric: v[:100] if len(v) > 1 else v[0] for metric, v in self.values.items()}
+            definitions = [{'Name': metric, 'Unit': self.units[metric]} for metric in self.values]
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [['Handler']],
+                    'Metrics': definitions
+                }]
+            },
+            'Handler': self.handler
+        }
+        document.update(values)
+        # EMF lines must reach the log as bare JSON, without the logging prefix
+        sys.stdout.write(json.dumps(document) + '\n')
+        sys.stdout.flush()
+
+
+@contextlib.contextmanager
+def trace(handler):
+    t = Trace(handler) if random.random() < sample_rate else None
+    token = current.set(t)
+    try:
+        yield t
+    finally:
+        current.reset(token)
+        if t is not None:
+            t.add('total', (time.perf_counter() - t.start) * 1000, 'Milliseconds')
+            t.emit()
+
+
+@contextlib.contextmanager
+def timer(stage):
+    t = current.get()
+    if t is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        t.add(stage, (time.perf_counter() - start) * 1000, 'Milliseconds')
+
+
+def record(metric, value, unit='Milliseconds'):
+    t = current.get()
+    if t is not None:
+        t.add(metric, value, unit)
+
+
+def count(metric, n=1):
+    record(metric, n, 'Count')
+
+
+# Carries the trace of the caller into a worker thread (executors do not copy context variables)
+def bind(fn):
+    t = current.get()
+
+    def run(*args, **kwargs):
+        token = current.set(t)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            current.reset(token)
+    return run
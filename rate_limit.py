@@ -0,0 +1,158 @@
+import os
+import logging
+
+import decimal
+import math
+import threading
+import time
+
+import aws
+import metrics
+
+logger = logging.getLogger()
+
+# Token bucket shared by every container calling Calil with the same appkey.
+# rate is in requests per second for the whole cluster, burst is the bucket size.
+rate = float(os.getenv('CALIL_RATE', '4'))
+burst = float(os.getenv('CALIL_BURST', '10'))
+# Share of the bucket that background work (cache refreshes, watch checks) leaves for interactive lookups
+background_reserve = float(os.getenv('CALIL_BACKGROUND_RESERVE', '0.5'))
+# Tokens taken from the shared bucket per DynamoDB round trip, and how long they may be spent locally
+lease_size = int(os.getenv('CALIL_RATE_LEASE', '2'))
+lease_ttl = 1.0
+# Longest wait for a token before giving up
+max_wait = float(os.getenv('CALIL_RATE_MAX_WAIT', '5'))
+
+table_name = os.getenv('RateLimitTableName', None)
+bucket_key = 'calil'
+max_retry = 3
+
+
+class RateLimited(Exception):
+    pass
+
+
+def reserve(priority):
+    return burst * background_reserve if priority == 'background' else 0.0
+
+
+# In-memory bucket used when no table is configured or the table cannot be reached
+class LocalBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, priority):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens - 1 < reserve(priority):
+                return False
+            self.tokens -= 1
+            return True
+
+    def remaining(self):
+        with self.lock:
+            return self.tokens
+
+
+# Bucket state in one DynamoDB item ({'bucket', 'tokens', 'updated'}), refilled from the wall clock on every
+# lease and written with a condition on 'updated' so that concurrent containers never hand out the same tokens.
+class DynamoDBBucket:
+    def __init__(self, table_name, rate, burst):
+        self.table_name = table_name
+        self.rate = rate
+        self.burst = burst
+        self.leased = 0
+        self.leased_at = 0.0
+        self.shared = burst
+        self.lock = threading.Lock()
+
+    def take(self, priority):
+        with self.lock:
+            if self.leased > 0 and time.monotonic() - self.leased_at < lease_ttl:
+                self.leased -= 1
+                return True
+            self.leased = 0
+            granted = self.lease(priority)
+            if granted == 0:
+                return False
+            self.leased = granted - 1
+            self.leased_at = time.monotonic()
+            return True
+
+    def lease(self, priority):
+        table = aws.table(self.table_name)
+        for attempt in range(max_retry):
+            item = table.get_item(Key = {'bucket': bucket_key}, ConsistentRead=True).get('Item')
+            now = time.time()
+            if item is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, float(item['tokens']) + (now - float(item['updated'])) * self.rate)
+            granted = min(lease_size, math.floor(tokens - reserve(priority)))
+            self.shared = tokens
+            if granted < 1:
+                return 0
+            kwargs = {
+                'Key': {'bucket': bucket_key},
+                'UpdateExpression': 'set tokens=:t, updated=:n',
+                'ExpressionAttributeValues': {
+                    ':t': decimal.Decimal(str(round(tokens - granted, 6))),
+                    ':n': decimal.Decimal(str(now))
+                }
+            }
+            if item is None:
+                kwargs['ConditionExpression'] = 'attribute_not_exists(updated)'
+            else:
+                kwargs['ConditionExpression'] = 'updated=:u'
+                kwargs['ExpressionAttributeValues'][':u'] = item['updated']
+            try:
+                table.update_item(**kwargs)
+            except Exception as e:
+                if aws.error_code(e) != 'ConditionalCheckFailedException':
+                    raise
+                continue
+            self.shared = tokens - granted
+            return granted
+        return 0
+
+    def remaining(self):
+        with self.lock:
+            return self.shared + self.leased
+
+
+local_bucket = LocalBucket(rate, burst)
+shared_bucket = DynamoDBBucket(table_name, rate, burst) if table_name is not None else None
+
+
+def take(priority):
+    if shared_bucket is not None:
+        try:
+            return shared_bucket.take(priority), shared_bucket
+        except Exception:
+            logger.exception('Rate limit table unavailable, using the local bucket')
+    return local_bucket.take(priority), local_bucket
+
+
+# Waits for a token for one Calil request. Returns False when none was available within timeout.
+def acquire(priority='interactive', timeout=None):
+    start = time.monotonic()
+    deadline = start + (max_wait if timeout is None else min(timeout, max_wait))
+    while True:
+        granted, bucket = take(priority)
+        now = time.monotonic()
+        if granted or now >= deadline:
+            break
+        time.sleep(min(max(1.0 / rate, 0.01), deadline - now))
+    metrics.record('calil_budget', bucket.remaining(), 'Count')
+    if now - start > 0.001:
+        metrics.record('calil_rate_wait', (now - start) * 1000)
+    if not granted:
+        metrics.count('calil_throttled')
+        logger.info('Calil rate limit reached (' + priority + ')')
+    return granted
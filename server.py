@@ -0,0 +1,192 @@
+import os
+import logging
+
+import concurrent.futures
+import signal
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Long-running alternative to AWS Lambda: a pre-fork HTTP server in front of lambda_handler.
+# Each worker process keeps its caches, connection pools and one warm BarcodeDetector per thread.
+#
+#   LINE_CHANNEL_SECRET=... LINE_CHANNEL_ACCESS_TOKEN=... python server.py
+
+# Images are decoded on the request threads, which already run in parallel across workers
+os.environ.setdefault('BARCODE_WORKERS', '1')
+
+import barcode
+import lambda_function
+
+logger = logging.getLogger()
+
+host = os.getenv('SERVER_HOST', '0.0.0.0')
+port = int(os.getenv('SERVER_PORT', '8080'))
+workers = int(os.getenv('SERVER_WORKERS', str(os.cpu_count() or 1)))
+# Request threads per worker
+threads = int(os.getenv('SERVER_THREADS', '8'))
+warm_detector = os.getenv('SERVER_WARM_DETECTOR', '1') == '1'
+max_body = 1024 * 1024
+# Nothing else runs worker_handler here, so each worker drains the event queue when the handler uses one
+# (PROCESSING_MODE=queue or queued follow-ups). Seconds between polls while the queue is empty.
+drain_queue = os.getenv('SERVER_DRAIN_QUEUE', '1' if lambda_function.processing_mode == 'queue' or lambda_function.followup_queue else '0') == '1'
+queue_poll = float(os.getenv('SERVER_QUEUE_POLL', '1'))
+
+
+# One request per connection (HTTP/1.0) so that idle keep-alive connections do not hold pool threads
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/health':
+            self.send(200, b'{}')
+        else:
+            self.send(404, b'{}')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', '0'))
+        if length > max_body:
+            self.send(413, b'{}')
+            return
+        event = {
+            'path': self.path,
+            'headers': dict(self.headers.items()),
+            'body': self.rfile.read(length).decode('utf-8')
+        }
+        try:
+            response = lambda_function.lambda_handler(event, None)
+        except Exception:
+            logger.exception('Webhook handling failed')
+            response = {'statusCode': 500, 'body': '{}'}
+        self.send(response['statusCode'], response.get('body', '').encode('utf-8'))
+
+    def send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+# Serves an inherited listening socket with a fixed pool of threads, so that thread-local
+# state such as the BarcodeDetector lives as long as the worker instead of one request
+class PooledHTTPServer(HTTPServer):
+    def __init__(self, sock, pool):
+        HTTPServer.__init__(self, sock.getsockname()[:2], WebhookHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.pool = pool
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        # The socket belongs to the master
+        pass
+
+
+def warm():
+    global warm_detector
+    if not warm_detector:
+        return
+    try:
+        barcode.init_worker()
+    except ImportError:
+        warm_detector = False
+        logger.info('OpenCV unavailable, images cannot be decoded')
+
+
+def drain(stopping):
+    while not stopping.is_set():
+        try:
+            count = lambda_function.worker_handler({}, None)['count']
+        except Exception:
+            logger.exception('Queue drain failed')
+            count = 0
+        if count == 0:
+            stopping.wait(queue_poll)
+
+
+def serve(sock):
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads, initializer=warm)
+    server = PooledHTTPServer(sock, pool)
+    stopping = threading.Event()
+    drainer = threading.Thread(target=drain, args=(stopping,), daemon=True) if drain_queue else None
+
+    def stop(signum, frame):
+        stopping.set()
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info('Worker ' + str(os.getpid()) + ' serving on ' + host + ':' + str(port))
+    if drainer is not None:
+        drainer.start()
+    server.serve_forever()
+    stopping.set()
+    pool.shutdown(wait=True)
+    if drainer is not None:
+        drainer.join()
+
+
+def main():
+    logging.basicConfig(level=logger.level, format='%(asctime)s %(process)d %(levelname)s %(message)s')
+    sock = socket.create_server((host, port), backlog=128)
+    if workers <= 1 or not hasattr(os, 'fork'):
+        serve(sock)
+        return
+
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                serve(sock)
+            except Exception:
+                logger.exception('Worker failed')
+                code = 1
+            finally:
+                os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for i in range(workers):
+        spawn()
+
+    # Workers that die are replaced until the server is stopped
+    while len(children) != 0:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            logger.error('Worker ' + str(pid) + ' exited (' + str(status) + '), restarting')
+            spawn()
+    sock.close()
+
+
+if __name__ == '__main__':
+    main()
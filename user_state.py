@@ -0,0 +1,279 @@
+import os
+import logging
+
+import decimal
+
+import aws
+import library_records
+import metrics
+
+logger = logging.getLogger()
+
+table_name = os.environ['TableName']
+
+max_retry = 3
+
+library_fields = ('libraries', 'favorites')
+
+# DynamoDB limits of BatchGetItem keys and TransactWriteItems actions per request
+batch_get_size = 100
+transact_size = 100
+
+
+# The row kept being written by other events, the operations were not stored
+class WriteConflict(Exception):
+    pass
+
+
+def to_item(value):
+    # DynamoDB does not accept float, store numbers as Decimal
+    if isinstance(value, float):
+        return decimal.Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: to_item(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [to_item(v) for v in value]
+    return value
+
+
+# One user row loaded once per invocation. Changes are recorded as operations so that
+# they can be replayed on a fresh copy of the row when another event wrote it first.
+class UserState:
+    def __init__(self, user_id, item=None):
+        self.user_id = user_id
+        self.ops = []
+        self.dirty = set()
+        self.set_item(item)
+
+    @classmethod
+    def load(cls, user_id):
+        with metrics.timer('dynamodb_get'):
+            response = aws.table(table_name).get_item(Key = {'userId': user_id}, ConsistentRead=True)
+        return cls(user_id, response.get('Item'))
+
+    # Library lists are stored as libids when library_records is enabled, rows written before
+    # hold full records. Those are registered and rewritten as libids with the next write.
+    def set_item(self, item):
+        self.exists = item is not None
+        item = item or {}
+        records = library_records.lookup(stored_libids(item))
+        for field in library_fields:
+            entries = list(item.get(field, []))
+            libraries = []
+            for entry in entries:
+                if isinstance(entry, dict):
+                    libraries.append(entry)
+                elif entry in records:
+                    libraries.append(records[entry])
+                else:
+                    logger.warning('Unknown library: ' + str(entry))
+            setattr(self, field, libraries)
+            if library_records.enabled() and any(isinstance(entry, dict) for entry in entries):
+                library_records.register(libraries)
+                self.dirty.add(field)
+        self.version = int(item.get('version', 0))
+
+    def stored(self, field):
+        libraries = getattr(self, field)
+        if library_records.enabled():
+            return [library['libid'] for library in libraries]
+        return libraries
+
+    def reset(self):
+        self.apply(('reset',))
+
+    def set_libraries(self, libraries):
+        if library_records.enabled():
+            library_records.register(libraries)
+        self.apply(('libraries', libraries))
+
+    def add_favorite(self, library, limit):
+        if library_records.enabled():
+            library_records.register([library])
+        self.apply(('add', library, limit))
+
+    def remove_favorite(self, libid):
+        self.apply(('remove', libid))
+
+    def clear_favorites(self):
+        self.apply(('clear',))
+
+    def apply(self, op, record=True):
+        if op[0] == 'reset':
+            self.libraries = []
+            self.favorites = []
+            self.dirty.update(['libraries', 'favorites'])
+        elif op[0] == 'libraries':
+            self.libraries = list(op[1])
+            self.dirty.add('libraries')
+        elif op[0] == 'add':
+            library, limit = op[1], op[2]
+            if len(self.favorites) < limit and all(favorite['libid'] != library['libid'] for favorite in self.favorites):
+                self.favorites.append(library)
+            self.dirty.add('favorites')
+        elif op[0] == 'remove':
+            self.favorites = [favorite for favorite in self.favorites if favorite['libid'] != op[1]]
+            self.dirty.add('favorites')
+        elif op[0] == 'clear':
+            self.favorites = []
+            self.dirty.add('favorites')
+        if record:
+            self.ops.append(op)
+
+    def reload(self):
+        with metrics.timer('dynamodb_get'):
+            response = aws.table(table_name).get_item(Key = {'userId': self.user_id}, ConsistentRead=True)
+        # set_item may mark legacy fields for migration, which the replayed write has to include
+        self.dirty = set()
+        self.set_item(response.get('Item'))
+        for op in self.ops:
+            self.apply(op, record=False)
+
+    def update_args(self):
+        names = {'#v': 'version'}
+        values = {':v': self.version, ':n': self.version + 1}
+        sets = ['#v=:n']
+        for field in sorted(self.dirty):
+            names['#' + field] = field
+            values[':' + field] = to_item(self.stored(field))
+            sets.append('#' + field + '=:' + field)
+        return {
+            'Key': {'userId': self.user_id},
+            'UpdateExpression': 'set ' + ', '.join(sets),
+            'ConditionExpression': 'attribute_not_exists(#v) OR #v=:v',
+            'ExpressionAttributeNames': names,
+            'ExpressionAttributeValues': values
+        }
+
+    def flushed(self):
+        self.version += 1
+        self.exists = True
+        self.ops = []
+        self.dirty = set()
+
+    # Single conditional write of the changed fields, optimistic on the version attribute
+    def flush(self):
+        if len(self.dirty) == 0:
+            return
+        for attempt in range(max_retry):
+            try:
+                aws.table(table_name).update_item(**self.update_args())
+                self.flushed()
+                return
+            except Exception as e:
+                if aws.error_code(e) != 'ConditionalCheckFailedException':
+                    raise
+                logger.info('User state conflict: ' + self.user_id)
+                self.reload()
+        raise WriteConflict('User state write failed: ' + self.user_id)
+
+
+def get_state(states, event_data):
+    user_id = event_data['source']['userId']
+    if user_id not in states:
+        states[user_id] = UserState.load(user_id)
+    return states[user_id]
+
+
+def stored_libids(item):
+    return [entry for field in library_fields for entry in item.get(field, []) if not isinstance(entry, dict)]
+
+
+# Loads the rows of all users of a webhook delivery with BatchGetItem,
+# and the library records they refer to with one lookup
+def load_all(user_ids):
+    items = []
+    user_ids = list(dict.fromkeys(user_ids))
+    for i in range(0, len(user_ids), batch_get_size):
+        request = {table_name: {
+            'Keys': [{'userId': user_id} for user_id in user_ids[i:i+batch_get_size]],
+            'ConsistentRead': True
+        }}
+        while len(request) != 0:
+            response = aws.resource('dynamodb').batch_get_item(RequestItems = request)
+            items += response['Responses'].get(table_name, [])
+            request = response.get('UnprocessedKeys', {})
+    library_records.lookup([libid for item in items for libid in stored_libids(item)])
+    states = {item['userId']: UserState(item['userId'], item) for item in items}
+    for user_id in user_ids:
+        if user_id not in states:
+            states[user_id] = UserState(user_id)
+    return states
+
+
+def user_ids(events):
+    return [event_data['source']['userId'] for event_data in events if 'userId' in event_data.get('source', {})]
+
+
+# Writes all changed rows with TransactWriteItems. When a transaction is cancelled
+# (a row was written by another event) the rows fall back to flush() which replays on conflict.
+# Every row is written even when one fails, then the first error is raised.
+def flush_all(states):
+    dirty = [state for state in states.values() if len(state.dirty) != 0]
+    error = None
+    for i in range(0, len(dirty), transact_size):
+        try:
+            flush_chunk(dirty[i:i+transact_size])
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        raise error
+
+
+def flush_chunk(chunk):
+    if len(chunk) == 1:
+        chunk[0].flush()
+        return
+    items = []
+    for state in chunk:
+        update = state.update_args()
+        update['TableName'] = table_name
+        items.append({'Update': update})
+    try:
+        aws.resource('dynamodb').meta.client.transact_write_items(TransactItems = items)
+    except Exception as e:
+        if aws.error_code(e) != 'TransactionCanceledException':
+            raise
+        logger.info('User state transaction cancelled')
+        flush_each(chunk)
+        return
+    for state in chunk:
+        state.flushed()
+
+
+# Flushes every state even when one fails, then raises the first error
+def flush_each(states):
+    error = None
+    for state in states:
+        try:
+            state.flush()
+        except Exception as e:
+            logger.error(str(e))
+            error = error or e
+    if error is not None:
+        raise error
+
+
+# One-off (or scheduled) sweep that rewrites the rows still holding full library records
+def migrate_handler(event, context):
+    if not library_records.enabled():
+        return {'migrated': 0}
+    migrated = 0
+    kwargs = {}
+    while True:
+        response = aws.table(table_name).scan(**kwargs)
+        for item in response.get('Items', []):
+            state = UserState(item['userId'], item)
+            if len(state.dirty) != 0:
+                try:
+                    state.flush()
+                except WriteConflict as e:
+                    # Left for the next sweep, or rewritten by the user's next event
+                    logger.error(str(e))
+                    continue
+                migrated += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    logger.info('User rows migrated: ' + str(migrated))
+    return {'migrated': migrated}
@@ -0,0 +1,122 @@
+import os
+import logging
+
+import time
+
+import aws
+import calil
+import line_api
+import messages
+
+logger = logging.getLogger()
+
+# Statuses that mean the book can be borrowed now
+available_status = ('貸出可', '蔵書あり')
+
+watch_ttl = int(os.getenv('WATCH_TTL', str(90 * 86400)))
+# ISBNs per Calil session of the scheduled check
+session_isbns = int(os.getenv('WATCH_SESSION_ISBNS', '20'))
+# Time allowed for all sessions of the scheduled check
+check_deadline = float(os.getenv('WATCH_CHECK_DEADLINE', '120'))
+
+table_name = os.getenv('WatchTableName', None)
+
+
+def enabled():
+    return table_name is not None
+
+
+# One item per (isbn, userId) holding the libraries to watch. Items expire through DynamoDB TTL ('ttl').
+def subscribe(user_id, isbn13, favorites):
+    aws.table(table_name).put_item(Item = {
+        'isbn': isbn13,
+        'userId': user_id,
+        'libraries': [{
+            'systemid': library['systemid'],
+            'libkey': library['libkey'],
+            'short': library['short']
+        } for library in favorites],
+        'ttl': int(time.time()) + watch_ttl
+    })
+
+
+def load_watches():
+    watches = []
+    kwargs = {}
+    while True:
+        response = aws.table(table_name).scan(**kwargs)
+        watches += response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return watches
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+# Calil sessions covering every watched (isbn, systemid) once. Systemids watched for the same
+# set of ISBNs share a session, and large ISBN sets are split into session_isbns per session.
+def plan_sessions(watches):
+    isbns_by_system = {}
+    for watch in watches:
+        for library in watch['libraries']:
+            isbns_by_system.setdefault(library['systemid'], set()).add(watch['isbn'])
+
+    systems_by_isbns = {}
+    for systemid, isbns in isbns_by_system.items():
+        systems_by_isbns.setdefault(frozenset(isbns), []).append(systemid)
+
+    sessions = []
+    for isbns, systemids in systems_by_isbns.items():
+        isbns = sorted(isbns)
+        for i in range(0, len(isbns), session_isbns):
+            sessions.append((isbns[i:i+session_isbns], ','.join(sorted(systemids))))
+    return sessions
+
+
+# Scheduled (e.g. EventBridge) entry point. One upstream check serves every subscriber of a book,
+# and users who get the same notification share one multicast.
+def scheduled_handler(event, context):
+    if table_name is None:
+        return {'notified': 0}
+    watches = load_watches()
+    sessions = plan_sessions(watches)
+    logger.info('Watches: ' + str(len(watches)) + ', sessions: ' + str(len(sessions)))
+
+    statuses = {}
+    # Interactive lookups go first, the check only uses what the rate limit leaves
+    # A failed session leaves its watches for the next run
+    for session, res in zip(sessions, calil.check_many(sessions, check_deadline, 'background', return_exceptions=True)):
+        if isinstance(res, Exception):
+            logger.error('Watch check failed: ' + ','.join(session[0]) + ': ' + str(res))
+            continue
+        statuses.update(res.statuses)
+
+    recipients = {}
+    for watch in watches:
+        lines = []
+        for library in watch['libraries']:
+            status = statuses.get((watch['isbn'], library['systemid'], library['libkey']))
+            if status in available_status:
+                lines.append(library['short'] + '：' + status)
+        if len(lines) != 0:
+            recipients.setdefault((watch['isbn'], tuple(lines)), []).append(watch)
+
+    # Notifications are sent once, the user subscribes again when needed. The watches of each multicast
+    # request are deleted as soon as it went out, those of a failed request are kept for the next run.
+    notified = 0
+    for (isbn13, lines), group in recipients.items():
+        message_body = [
+            messages.text('お待ちの書籍が借りられるようになりました。\n' + '\n'.join(lines)),
+            messages.carousel('ISBN ' + isbn13, [messages.book_column('お待ちの書籍', 'ISBN ' + isbn13, isbn13)])
+        ]
+        for i in range(0, len(group), line_api.multicast_size):
+            chunk = group[i:i+line_api.multicast_size]
+            try:
+                line_api.multicast([watch['userId'] for watch in chunk], message_body)
+            except Exception:
+                logger.exception('Watch notification failed: ' + isbn13)
+                continue
+            with aws.table(table_name).batch_writer() as batch:
+                for watch in chunk:
+                    batch.delete_item(Key = {'isbn': watch['isbn'], 'userId': watch['userId']})
+            notified += len(chunk)
+
+    return {'notified': notified}